@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the diffengine check pipeline.
+
+The recorded feeds and article pages in test-data are served from a local
+HTTP server, so the numbers only depend on diffengine itself and not on the
+network. Each stage reports its time, throughput and the process memory
+high-water mark, and can be compared against a stored baseline:
+
+    python bench_diffengine.py --save-baseline
+    python bench_diffengine.py
+
+Screenshots are only benchmarked when --browser is given, since they need a
+working webdriver. Nothing is sent to the Internet Archive.
+"""
+
+import argparse
+import json
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import htmldiff2
+
+import diffengine
+
+from diffengine import Diff, Entry, EntryVersion, Feed, _fingerprint
+from diffengine.textdiff import render_diff
+from diffengine.utils import generate_config
+
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test-data")
+default_baseline = os.path.join(data_dir, "bench-baseline.json")
+
+
+class Fixtures(BaseHTTPRequestHandler):
+    """
+    Serves copies of the recorded feeds with their links pointing back at
+    this server, and the recorded article for every other path, made into
+    a story of its own for each path so that they aren't taken for
+    duplicates of each other. Setting revision on the server switches to
+    the edited article.
+    """
+
+    def do_GET(self):
+        m = re.match(r"^/(\d+)/(feed\d)\.xml$", self.path)
+        if m:
+            copy, name = m.groups()
+            with open(os.path.join(data_dir, name + ".xml"), encoding="utf8") as fh:
+                feed = fh.read()
+            base = "http://%s:%s/%s" % (*self.server.server_address, copy)
+            feed = re.sub(r"https?://www\.washingtonpost\.com", base, feed)
+            return self._send(feed, "application/rss+xml")
+        if self.path == "/robots.txt":
+            return self._send("", "text/plain", 404)
+        name = "article%s.html" % self.server.revision
+        with open(os.path.join(data_dir, name), encoding="utf8") as fh:
+            return self._send(story(fh.read(), self.path), "text/html")
+
+    def _send(self, text, content_type, status=200):
+        body = text.encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def story(article, path):
+    words = " ".join(re.findall(r"[a-z]+|\d+", path.lower()))
+    article = re.sub(r"(<title>|<h1>)", r"\g<1>%s: " % words, article, count=2)
+    return article.replace(
+        '<div class="article-body">',
+        '<div class="article-body">\n<p>This is the story filed as %s.</p>' % words,
+    )
+
+
+class Stage:
+    def __init__(self, name, count):
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def result(self):
+        return {
+            "seconds": round(self.seconds, 4),
+            "count": self.count,
+            "per_second": round(self.count / self.seconds, 2) if self.seconds else None,
+            "maxrss_kb": self.maxrss,
+        }
+
+
+def start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Fixtures)
+    server.revision = 1
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def setup(home, browser=False):
+    generate_config(home, {"db": "sqlite:///:memory:", "politeness": {"robots": False}})
+    diffengine.home = home
+    diffengine.load_config(prompt=False)
+    diffengine.setup_db()
+    diffengine.artifacts = diffengine.setup_artifacts()
+    diffengine.http_client = diffengine.setup_http_client()
+    diffengine.throttle = diffengine.setup_throttle()
+    if browser:
+        diffengine.browser = diffengine.setup_browser(
+            diffengine.config.get("webdriver.engine", "geckodriver"),
+            diffengine.config.get("webdriver.executable_path"),
+            diffengine.config.get("webdriver.binary_location"),
+        )
+
+
+def run(copies=5, rounds=20, browser=False):
+    results = {}
+    server = start_server()
+    host, port = server.server_address
+    feeds = [
+        Feed.create(
+            name="%s-%s" % (name, i),
+            url="http://%s:%s/%s/%s.xml" % (host, port, i, name),
+        )
+        for i in range(copies)
+        for name in ("feed1", "feed2")
+    ]
+
+    with Stage("feed.get_latest", len(feeds)) as stage:
+        for feed in feeds:
+            feed.get_latest()
+    results[stage.name] = stage.result()
+
+    entries = list(Entry.select())
+    with Stage("entry.get_latest.first", len(entries)) as stage:
+        for entry in entries:
+            entry.get_latest()
+    results[stage.name] = stage.result()
+
+    with Stage("entry.get_latest.unchanged", len(entries)) as stage:
+        for entry in entries:
+            entry.get_latest()
+    results[stage.name] = stage.result()
+
+    server.revision = 2
+    with Stage("entry.get_latest.changed", len(entries)) as stage:
+        for entry in entries:
+            entry.get_latest()
+    results[stage.name] = stage.result()
+
+    summaries = [v.summary for v in EntryVersion.select()]
+    with Stage("fingerprint", len(summaries) * rounds) as stage:
+        for i in range(rounds):
+            for summary in summaries:
+                _fingerprint(summary)
+    results[stage.name] = stage.result()
+
+    diffs = list(Diff.select())
+    pairs = [(d.old.html, d.new.html) for d in diffs[:rounds]]
+    with Stage("htmldiff", len(pairs)) as stage:
+        for old, new in pairs:
+            htmldiff2.render_html_diff(old, new)
+    results[stage.name] = stage.result()
+
+    with Stage("textdiff", len(pairs)) as stage:
+        for old, new in pairs:
+            render_diff(old, new)
+    results[stage.name] = stage.result()
+
+    if browser:
+        sample = diffs[:rounds]
+        with Stage("screenshot", len(sample)) as stage:
+            for diff in sample:
+                diff._generate_diff_images()
+        results[stage.name] = stage.result()
+
+    server.shutdown()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or not base["seconds"]:
+            continue
+        change = (result["seconds"] - base["seconds"]) / base["seconds"]
+        flag = ""
+        if change > tolerance:
+            flag = "  <-- regression"
+            regressions.append(name)
+        print("%-30s %+7.1f%%%s" % (name, change * 100, flag))
+    return regressions
+
+
+def report(results):
+    print(
+        "%-30s %10s %8s %12s %12s"
+        % ("stage", "seconds", "count", "per second", "maxrss kb")
+    )
+    for name, r in results.items():
+        print(
+            "%-30s %10.4f %8d %12s %12d"
+            % (name, r["seconds"], r["count"], r["per_second"], r["maxrss_kb"])
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--copies", type=int, default=5, help="copies of each feed")
+    parser.add_argument("--rounds", type=int, default=20, help="micro benchmark rounds")
+    parser.add_argument("--browser", action="store_true", help="benchmark screenshots")
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="slowdown relative to the baseline that counts as a regression",
+    )
+    options = parser.parse_args()
+
+    home = tempfile.mkdtemp()
+    try:
+        setup(home, options.browser)
+        # archive.org is not part of what is being measured, and without a
+        # browser the screenshots are left out too
+        with patch.object(EntryVersion, "archive", return_value=None):
+            if options.browser:
+                results = run(options.copies, options.rounds, True)
+            else:
+                with patch.object(Diff, "_generate_diff_images", return_value=None):
+                    results = run(options.copies, options.rounds)
+    finally:
+        if diffengine.browser:
+            diffengine.browser.quit()
+        shutil.rmtree(home)
+
+    report(results)
+
+    if options.save_baseline:
+        with open(options.baseline, "w") as fh:
+            json.dump(results, fh, indent=2)
+        print("\nsaved baseline to %s" % options.baseline)
+    elif os.path.isfile(options.baseline):
+        print("\ncompared with %s" % options.baseline)
+        with open(options.baseline) as fh:
+            regressions = compare(results, json.load(fh), options.tolerance)
+        if regressions:
+            sys.exit("performance regressions in: %s" % ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,14 @@
 UA = "diffengine/0.2.7 (+https://github.com/docnow/diffengine)"
 
 import os
+import json
+import gzip
+import hashlib
 import re
 import sys
+import tempfile
 import time
+import threading
 import yaml
 import bleach
 import codecs
@@ -17,41 +22,98 @@ import shutil
 import tweepy
 import logging
 import argparse
-import requests
+import contextlib
 import htmldiff2
 import feedparser
 import readability
 import unicodedata
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import islice
+from urllib.parse import urlparse
+from diffengine import images
+from diffengine.artifacts import LocalStore, S3Store
+from diffengine.cache import ResponseCache
+from diffengine.canonical import STRIP_PARAMS, Canonicalizer, front_page
+from diffengine.exceptions.artifacts import ArtifactStoreError
+from diffengine.exceptions.http import CacheMissError
 from diffengine.exceptions.webdriver import UnknownWebdriverError
 from diffengine.exceptions.sendgrid import SendgridConfigNotFoundError, SendgridError
 from diffengine.exceptions.twitter import TwitterConfigNotFoundError, TwitterError
+from diffengine.metrics import (
+    JSONLinesSink,
+    Metrics,
+    PrometheusFileSink,
+    PrometheusHTTPSink,
+    StatsDSink,
+)
+from diffengine.politeness import CircuitBreaker, HostThrottle
+from diffengine.retention import sweep
+from diffengine.schedule import HOUR, AdaptiveSchedule
+from diffengine.runs import Checkpoint, Deadline, RunLock, fair_share, resume
+from diffengine.profiling import profile, write_stages
+from diffengine.session import HTTPClient
+from diffengine.similarity import signature, similarity
 from diffengine.sendgrid import SendgridHandler
-from diffengine.text import to_utf8, matches
+from diffengine.text import ItemRule, SkipRule, to_utf8
+from diffengine.textdiff import (
+    clip,
+    compose,
+    matching_blocks,
+    opcodes,
+    render_diff,
+    tokenize,
+)
 from diffengine.twitter import TwitterHandler
 from envyaml import EnvYAML
 from peewee import (
     DatabaseProxy,
     CharField,
     DateTimeField,
+    DeferredForeignKey,
+    IntegerField,
+    InternalError,
     OperationalError,
     ForeignKeyField,
     Model,
-    SqliteDatabase,
+    MySQLDatabase,
+    PostgresqlDatabase,
+    ProgrammingError,
+    SQL,
     TextField,
+    fn,
 )
 from playhouse.db_url import connect
-from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.migrate import SchemaMigrator, migrate
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options as ChromeOptions
 from selenium.webdriver.firefox.options import Options as FirefoxOptions
-from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
 
 home = None
 config = {}
 database = DatabaseProxy()
 browser = None
+throttle = HostThrottle()
+breaker = CircuitBreaker(failures=0)
+scheduler = None
+canonicalizer = Canonicalizer()
+skip_rules = {}
+item_rules = {}
+signal_backoffs = {}
+http_client = HTTPClient(UA)
+response_cache = None
+metrics = Metrics()
+artifacts = None
+archiving = True
+
+
+# the lifecycle of an entry
+ACTIVE = "active"
+COOLING = "cooling"
+RETIRED = "retired"
+
+# how long an entry waits between checks, as a share of its age
+STALE_RATIO = {ACTIVE: 0.2, COOLING: 0.5}
 
 
 class BaseModel(Model):
@@ -70,14 +132,21 @@ class Feed(BaseModel):
             Entry.select()
             .join(FeedEntry)
             .join(Feed)
-            .where(Feed.url == self.url)
+            .where(
+                Feed.url == self.url,
+                Entry.duplicate_of.is_null(),
+                FeedEntry.skipped.is_null(),
+            )
             .order_by(Entry.created.desc())
         )
 
-    def get_latest(self):
+    def get_latest(self, item_rule=None, max_age=None):
         """
         Gets the feed and creates new entries for new content. The number
-        of new entries created will be returned.
+        of new entries created will be returned. Items that match the
+        item_rule are marked as skipped for this feed, and are left out of
+        Feed.entries so they don't get fetched. Entries the feed says were
+        updated are made due, unless they are older than max_age days.
         """
         logging.info("fetching feed: %s", self.url)
         try:
@@ -86,20 +155,85 @@ class Feed(BaseModel):
         except Exception as e:
             logging.error("unable to fetch feed %s: %s", self.url, str(e))
             return 0
+        # look up the entries and this feed's links to them for all the
+        # items at once, rather than with a couple of queries per item
+        items = [(e, canonicalizer.url(e.link)) for e in feed.entries]
+        urls = {url for e, url in items} | {e.link for e, url in items}
+        entries = {}
+        for entry in Entry.select().where(Entry.url.in_(list(urls))).order_by(Entry.id):
+            entries.setdefault(entry.url, entry)
+        feed_entries = dict.fromkeys(e.id for e in entries.values())
+        for fe in FeedEntry.select().where(
+            FeedEntry.feed == self, FeedEntry.entry.in_(list(feed_entries))
+        ):
+            feed_entries[fe.entry_id] = fe
+
         count = 0
-        for e in feed.entries:
+        for e, url in items:
             # note: look up with url only, because there may be
             # overlap bewteen feeds, especially when a large newspaper
             # has multiple feeds
-            entry, created = Entry.get_or_create(url=e.link)
+            entry = entries.get(url) or entries.get(e.link)
+            created = entry is None
             if created:
-                FeedEntry.create(entry=entry, feed=self)
-                logging.info("found new entry: %s", e.link)
-                count += 1
-            elif len(entry.feeds.where(Feed.url == self.url)) == 0:
-                FeedEntry.create(entry=entry, feed=self)
-                logging.debug("found entry from another feed: %s", e.link)
+                entry = Entry.create(url=url)
+                entries[url] = entry
+            elif entry.duplicate_of_id:
+                entry = entry.original
+
+            # skip items this feed's rules say aren't worth fetching, which
+            # other feeds with the same article may not
+            skipped = _skipped_item(item_rule, e)
+
+            # the feed may say when the item was updated, and what it says
+            # about the item can change when the article is edited
+            updated = _item_updated(e)
+            digest = _item_digest(e)
+            feed_entry = feed_entries.get(entry.id)
+            if not created and entry.id not in feed_entries:
+                # a duplicate's original may not have been looked up yet
+                feed_entry = FeedEntry.get_or_none(
+                    FeedEntry.feed == self, FeedEntry.entry == entry
+                )
+            if feed_entry is None:
+                feed_entries[entry.id] = FeedEntry.create(
+                    entry=entry,
+                    feed=self,
+                    item_updated=updated,
+                    item_digest=digest,
+                    skipped=skipped,
+                )
+                if skipped:
+                    logging.info(
+                        "skipping %s: its %s matches skip_items", e.link, skipped
+                    )
+                if created:
+                    logging.info("found new entry: %s", e.link)
+                else:
+                    logging.debug("found entry from another feed: %s", e.link)
                 count += 1
+                continue
+
+            changed = False
+            if skipped != feed_entry.skipped:
+                if skipped:
+                    logging.info(
+                        "skipping %s: its %s matches skip_items", e.link, skipped
+                    )
+                feed_entry.skipped = skipped
+                changed = True
+            if (feed_entry.item_updated, feed_entry.item_digest) != (updated, digest):
+                if (feed_entry.item_updated and feed_entry.item_updated != updated) or (
+                    feed_entry.item_digest and feed_entry.item_digest != digest
+                ):
+                    logging.info("feed says %s was updated", e.link)
+                    entry.due(max_age)
+                    metrics.inc("diffengine_feed_updates_total")
+                feed_entry.item_updated = updated
+                feed_entry.item_digest = digest
+                changed = True
+            if changed:
+                feed_entry.save()
 
         return count
 
@@ -109,11 +243,32 @@ class Entry(BaseModel):
     created = DateTimeField(default=datetime.utcnow)
     checked = DateTimeField(default=datetime.utcnow)
     tweet_status_id_str = CharField(null=False, default="")
+    duplicate_of = ForeignKeyField("self", null=True, backref="duplicates")
+    state = CharField(default=ACTIVE, index=True)
+    unchanged_checks = IntegerField(default=0)
+    changes = IntegerField(default=0)
+    next_check = DateTimeField(null=True, index=True)
+    # the latest version, and hashes of its title and summary fingerprint,
+    # so that unchanged content can be spotted without loading the version
+    latest_version = DeferredForeignKey("EntryVersion", null=True, backref="+")
+    latest_title_hash = CharField(null=True)
+    latest_summary_hash = CharField(null=True)
 
     @property
     def feeds(self):
         return Feed.select().join(FeedEntry).join(Entry).where(Entry.id == self.id)
 
+    @property
+    def original(self):
+        """
+        The entry that this one turned out to be a duplicate of, or the
+        entry itself if it isn't a duplicate.
+        """
+        entry = self
+        while entry.duplicate_of_id:
+            entry = entry.duplicate_of
+        return entry
+
     @property
     def stale(self):
         """
@@ -126,26 +281,67 @@ class Entry(BaseModel):
         if not self.checked:
             return True
 
-        # time since the entry was created
-        hotness = (datetime.utcnow() - self.created).seconds
-        if hotness == 0:
-            return True
-
-        # time since the entry was last checked
-        staleness = (datetime.utcnow() - self.checked).seconds
-
-        # ratio of staleness to hotness
-        r = staleness / float(hotness)
-
-        # TODO: allow this magic number to be configured per feed?
-        if r >= 0.2:
-            logging.debug("%s is stale (r=%f)", self.url, r)
+        next_check = self.next_check or self._next_check()
+        if datetime.utcnow() >= next_check:
+            logging.debug("%s is stale (due %s)", self.url, next_check)
             return True
 
-        logging.debug("%s not stale (r=%f)", self.url, r)
+        logging.debug("%s not stale (due %s)", self.url, next_check)
         return False
 
-    def get_latest(self, skip_pattern=None):
+    def _next_check(self, feed=None):
+        # kept on the entry so that the due entries can be found in sql.
+        # feeds that say when their items are updated can be trusted to
+        # make the entry due, so their entries can wait longer
+        backoff = signal_backoffs.get(feed, 1)
+        if scheduler:
+            observed = self.checked - self.created
+            interval = scheduler.interval(self.changes, observed, feed)
+            return self.checked + interval * backoff
+
+        # an entry is stale once the time since it was checked is a share
+        # of its age, and entries that are cooling down get a bigger share
+        r = STALE_RATIO.get(self.state, STALE_RATIO[ACTIVE])
+        return self.checked + (self.checked - self.created) * (r / (1 - r) * backoff)
+
+    def due(self, max_age=None):
+        """
+        Makes the entry due to be checked now, bringing it back if it was
+        retired, for when there is reason to think it has changed. Entries
+        older than max_age days stay retired.
+        """
+        now = datetime.utcnow()
+        self.next_check = now
+        if self.state == RETIRED and not (
+            max_age and self.created < now - timedelta(days=max_age)
+        ):
+            self.state = ACTIVE
+            self.unchanged_checks = 0
+        self.save()
+
+    def update_state(self, cool_after=None, retire_after=None, feed=None):
+        """
+        Moves the entry along its lifecycle after a check: entries that
+        haven't changed for cool_after checks are checked less often, and
+        once they haven't changed for retire_after checks they are retired
+        and not checked again. A change makes an entry active again. The
+        url of the feed the entry was checked for is used to schedule it.
+        """
+        if retire_after and self.unchanged_checks >= retire_after:
+            state = RETIRED
+        elif cool_after and self.unchanged_checks >= cool_after:
+            state = COOLING
+        else:
+            state = ACTIVE
+        if state != self.state:
+            logging.info("%s is now %s", self.url, state)
+            self.state = state
+            if self.checked and not scheduler:
+                self.next_check = self._next_check(feed)
+            self.save()
+        return state
+
+    def get_latest(self, skip_pattern=None, similarity_threshold=None, feed=None):
         """
         get_latest is the heart of the application. It will get the current
         version on the web, extract its summary with readability and compare
@@ -154,13 +350,10 @@ class Entry(BaseModel):
         Archive to create a snapshot.
 
         If a new version was found it will be returned, otherwise None will
-        be returned.
+        be returned. feed is the url of the feed the entry is being checked
+        for, whose history is used to schedule the next check.
         """
 
-        time_sleep = config.get("time_sleep", 0)
-        if time_sleep > 0:
-            time.sleep(time_sleep)
-
         # fetch the current readability-ized content for the page
         logging.info("checking %s", self.url)
         try:
@@ -173,46 +366,116 @@ class Entry(BaseModel):
             logging.warn("Got %s when fetching %s", resp.status_code, self.url)
             return None
 
-        doc = readability.Document(to_utf8(resp.text))
-        title = doc.title()
-        summary = doc.summary(html_partial=True)
-        summary = bleach.clean(summary, tags=["p"], strip=True)
-        summary = _normal(summary)
+        with metrics.timer("readability"):
+            doc = readability.Document(to_utf8(resp.text))
+            title = doc.title()
+            summary = doc.summary(html_partial=True)
+        with metrics.timer("normalize"):
+            summary = bleach.clean(summary, tags=["p"], strip=True)
+            summary = _normal(summary)
 
         # if the title or the summay contains the skipping pattern,
         # then return none as I don't want to report this change
-        if skip_pattern and (
-            matches(skip_pattern, title) or matches(skip_pattern, summary)
-        ):
+        if isinstance(skip_pattern, str):
+            skip_pattern = SkipRule(skip_pattern)
+        if skip_pattern and skip_pattern.matches(title, summary):
             logging.info(
                 "Skipped page. It matches the skip_pattern prop defined for this feed."
             )
             return None
 
-        # in case there was a redirect, and remove utm style marketing
-        canonical_url = _remove_utm(resp.url)
-
-        # get the latest version, if we have one
-        versions = (
-            EntryVersion.select()
-            .where(EntryVersion.url == canonical_url)
-            .order_by(-EntryVersion.created)
-            .limit(1)
+        # in case there was a redirect, and remove tracking parameters. A
+        # rel=canonical that points at the front of the site or of a section
+        # says nothing about the article, so the page's own url is used
+        page_url = canonicalizer.url(resp.url)
+        canonical_url = canonicalizer.page_url(resp.url, resp.text)
+        if front_page(canonical_url, page_url):
+            canonical_url = page_url
+        with metrics.timer("fingerprint"):
+            fingerprint = _fingerprint(summary)
+        title_hash = _sha1(title)
+        summary_hash = _sha1(fingerprint)
+        content_hash = (
+            summary_hash if len(fingerprint) >= MIN_DUPLICATE_LENGTH else None
         )
-        if len(versions) == 0:
-            old = None
-        else:
-            old = versions[0]
 
-        # compare what we got against the latest version and create a
-        # new version if it looks different, or is brand new (no old version)
-        new = None
+        # the page may already be tracked by another entry that got to it
+        # through a different url, or that is a copy of it somewhere else.
+        # merging is for good, so it isn't done when the entry was sent to a
+        # front page or to another site, as with consent and paywall pages
+        if (
+            not self.latest_version_id
+            and self._mergeable(page_url)
+            and not self.versions.exists()
+        ):
+            with metrics.timer("db"):
+                original = self._find_original(canonical_url, content_hash)
+            if original:
+                self._merge_into(original)
+                return None
 
-        # use _equal to determine if the summaries are the same
-        if not old or old.title != title or not _equal(old.summary, summary):
-            new = EntryVersion.create(
-                title=title, url=canonical_url, summary=summary, entry=self
+        # compare what we got against the latest version and create a
+        # new version if it looks different, or is brand new (no old version).
+        # the hashes of the latest version are kept on the entry, so it only
+        # needs to be loaded when something changed
+        new = old = None
+        if self.latest_version_id:
+            changed = (
+                self.latest_title_hash != title_hash
+                or self.latest_summary_hash != summary_hash
             )
+            if changed:
+                with metrics.timer("db"):
+                    old = self.latest_version
+        else:
+            # entries from before the latest version was kept on them
+            with metrics.timer("db"):
+                old = (
+                    EntryVersion.select()
+                    .where(
+                        (EntryVersion.url == canonical_url)
+                        | (EntryVersion.entry == self)
+                    )
+                    .order_by(-EntryVersion.created)
+                    .first()
+                )
+            if old:
+                self._point_to(old)
+            changed = (
+                not old
+                or self.latest_title_hash != title_hash
+                or self.latest_summary_hash != summary_hash
+            )
+
+        # and ignore small changes like rotating blurbs when the feed has
+        # a similarity threshold
+        sig = None
+        if changed and old and old.title == title and similarity_threshold:
+            with metrics.timer("similarity"):
+                sig = signature(summary)
+                score = similarity(old.signature(), sig)
+            if score >= similarity_threshold:
+                logging.info(
+                    "skipped near duplicate (%.2f similar) of version #%s: %s",
+                    score,
+                    old.id,
+                    self.url,
+                )
+                metrics.inc("diffengine_near_duplicates_total")
+                changed = False
+
+        if changed:
+            with database.atomic():
+                new = EntryVersion.create(
+                    title=title,
+                    url=canonical_url,
+                    summary=summary,
+                    entry=self,
+                    minhash=sig,
+                    content_hash=content_hash,
+                )
+                self._point_to(new, title_hash, summary_hash)
+                self.save()
             new.archive()
             if old:
                 logging.debug("found new version %s", old.entry.url)
@@ -224,23 +487,73 @@ class Entry(BaseModel):
                         new.id,
                         self.url,
                     )
-                    new.delete()
+                    with database.atomic():
+                        self._point_to(old)
+                        self.save()
+                        diff.delete_instance()
+                        new.delete_instance()
                     new = None
+                else:
+                    self.changes += 1
             else:
                 logging.debug("found first version: %s", self.url)
         else:
             logging.debug("content hasn't changed %s", self.url)
 
+        self.unchanged_checks = 0 if new else self.unchanged_checks + 1
         self.checked = datetime.utcnow()
-        self.save()
+        self.next_check = self._next_check(feed)
+        with metrics.timer("db"):
+            self.save()
 
         return new
 
+    def _point_to(self, version, title_hash=None, summary_hash=None):
+        self.latest_version = version
+        self.latest_title_hash = title_hash or _sha1(version.title)
+        self.latest_summary_hash = summary_hash or _sha1(_fingerprint(version.summary))
+
+    def _mergeable(self, page_url):
+        entry_url = canonicalizer.url(self.url)
+        return not front_page(page_url, entry_url) and (
+            urlparse(page_url).netloc == urlparse(entry_url).netloc
+        )
+
+    def _find_original(self, canonical_url, content_hash):
+        match = EntryVersion.url == canonical_url
+        # short pages like paywalls and error pages are too alike to trust
+        if content_hash:
+            match = match | (EntryVersion.content_hash == content_hash)
+        version = (
+            EntryVersion.select()
+            .where(match, EntryVersion.entry != self)
+            .order_by(EntryVersion.created)
+            .first()
+        )
+        if version is None:
+            return None
+        original = version.entry.original
+        return None if original.id == self.id else original
+
+    def _merge_into(self, original):
+        logging.info("%s is a duplicate of %s", self.url, original.url)
+        for feed in self.feeds:
+            FeedEntry.get_or_create(entry=original, feed=feed)
+        self.duplicate_of = original
+        self.checked = datetime.utcnow()
+        self.save()
+        metrics.inc("diffengine_duplicates_total")
+
 
 class FeedEntry(BaseModel):
     feed = ForeignKeyField(Feed)
     entry = ForeignKeyField(Entry)
     created = DateTimeField(default=datetime.utcnow)
+    # when the feed last said the item was updated, and a hash of the item
+    item_updated = DateTimeField(null=True)
+    item_digest = CharField(null=True)
+    # what made the feed's skip_items rules skip the item, if they did
+    skipped = CharField(null=True)
 
 
 class EntryVersion(BaseModel):
@@ -251,6 +564,8 @@ class EntryVersion(BaseModel):
     archive_url = TextField(null=True)
     entry = ForeignKeyField(Entry, backref="versions")
     tweet_status_id_str = CharField(null=False, default="")
+    minhash = TextField(null=True)
+    content_hash = CharField(null=True, index=True)
 
     @property
     def diff(self):
@@ -279,10 +594,52 @@ class EntryVersion(BaseModel):
     def html(self):
         return "<h1>%s</h1>\n\n%s" % (self.title, self.summary)
 
+    def signature(self):
+        """
+        The MinHash signature of the summary, which is worked out the first
+        time it is needed and then stored.
+        """
+        if not self.minhash:
+            self.minhash = signature(self.summary)
+            if self.id:
+                self.save()
+        return self.minhash
+
+    def diff_to(self, later):
+        """
+        Returns the html diff between this version and a later version of
+        the same entry. It is put together from the stored edit scripts of
+        the diffs in between, so none of the versions are diffed again.
+        """
+        diffs = dict(
+            (d.old_id, d)
+            for d in Diff.select()
+            .join(EntryVersion, on=Diff.old)
+            .where(EntryVersion.entry == self.entry)
+        )
+        blocks = None
+        version_id = self.id
+        while version_id != later.id:
+            diff = diffs.get(version_id)
+            if diff is None:
+                logging.debug("no diffs from %s to %s", self.id, later.id)
+                blocks = None
+                break
+            edit = diff.edit_blocks()
+            blocks = edit if blocks is None else compose(blocks, edit)
+            version_id = diff.new_id
+        return render_diff(self.html, later.html, blocks)
+
     def archive(self):
+        if not archiving:
+            return None
+        with metrics.timer("archive"):
+            return self._archive()
+
+    def _archive(self):
         save_url = "https://web.archive.org/save/" + self.url
         try:
-            resp = _get(save_url)
+            resp = _get(save_url, cache=False)
             archive_url = resp.headers.get("Content-Location")
             if archive_url:
                 self.archive_url = "https://web.archive.org" + archive_url
@@ -311,6 +668,7 @@ class Diff(BaseModel):
     tweeted = DateTimeField(null=True)
     emailed = DateTimeField(null=True)
     blogged = DateTimeField(null=True)
+    edit_script = TextField(null=True)
 
     @property
     def url_changed(self):
@@ -324,21 +682,31 @@ class Diff(BaseModel):
     def summary_changed(self):
         return self.old.summary != self.new.summary
 
+    @property
+    def html_name(self):
+        return "%s.html" % self.id
+
+    @property
+    def screenshot_name(self):
+        return "%s.png" % self.id
+
+    @property
+    def thumbnail_name(self):
+        return "%s-thumb.png" % self.id
+
     @property
     def html_path(self):
-        # use prime number to spread across directories
-        path = home_path("diffs/%s/%s.html" % ((self.id % 257), self.id))
-        if not os.path.isdir(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
-        return path
+        return artifacts.local_path(self.id, self.html_name)
 
     @property
     def screenshot_path(self):
-        return self.html_path.replace(".html", ".png")
+        self._generate_diff_images()
+        return artifacts.local_path(self.id, self.screenshot_name)
 
     @property
     def thumbnail_path(self):
-        return self.screenshot_path.replace(".png", "-thumb.png")
+        self._generate_diff_images()
+        return artifacts.local_path(self.id, self.thumbnail_name)
 
     @property
     def url(self):
@@ -350,20 +718,72 @@ class Diff(BaseModel):
             snap(self.old.archive_url), snap(self.new.archive_url), self.old.url
         )
 
-    # TODO: configurable option for deleting the diffs after some time (1 week?)
+    def edit_blocks(self):
+        """
+        The matching blocks between the tokens of the old and new html. They
+        are worked out once and stored as the edit script for the diff.
+        """
+        if not self.edit_script:
+            ops = opcodes(tokenize(self.old.html), tokenize(self.new.html))
+            self.edit_script = json.dumps(matching_blocks(ops), separators=(",", ":"))
+            if self.id:
+                self.save()
+        return [tuple(b) for b in json.loads(self.edit_script)]
+
+    def read_html(self):
+        """
+        Returns the html for the diff, which may have been gzipped by the
+        retention policy, or None if it has been removed.
+        """
+        html = artifacts.read(self.id, self.html_name)
+        if html is None:
+            html = artifacts.read(self.id, self.html_name + ".gz")
+            html = gzip.decompress(html) if html is not None else None
+        if html is None:
+            # diffs from before the artifact store
+            path = self._legacy_path(self.html_name)
+            if os.path.isfile(path):
+                with open(path, "rb") as fh:
+                    html = fh.read()
+        return html.decode("utf8") if html is not None else None
+
+    def remove_files(self):
+        for name in (
+            self.html_name,
+            self.html_name + ".gz",
+            self.screenshot_name,
+            self.thumbnail_name,
+        ):
+            artifacts.delete(self.id, name)
+            if os.path.isfile(self._legacy_path(name)):
+                os.remove(self._legacy_path(name))
+
     def generate(self):
-        if self._generate_diff_html():
+        """
+        Creates the html for the diff, returning False if it shows no
+        changes. The screenshots are only taken when something asks for
+        them, see prepare.
+        """
+        return bool(self._generate_diff_html())
+
+    def prepare(self, names):
+        """
+        Makes sure the named artifacts ("html", "screenshot", "thumbnail")
+        exist, so that publishers can declare what they need up front.
+        """
+        if {"screenshot", "thumbnail"} & set(names):
             self._generate_diff_images()
-            return True
-        else:
-            return False
+
+    def _legacy_path(self, name):
+        return home_path("diffs/%s/%s" % ((self.id % 257), name))
 
     def _generate_diff_html(self):
-        if os.path.isfile(self.html_path):
+        if artifacts.exists(self.id, self.html_name):
             return
         tmpl_path = os.path.join(os.path.dirname(__file__), "diff.html")
-        logging.debug("creating html diff: %s", self.html_path)
-        diff = htmldiff2.render_html_diff(self.old.html, self.new.html)
+        logging.debug("creating html diff: %s", self.html_name)
+        with metrics.timer("htmldiff"):
+            diff = _render_diff(self.old.html, self.new.html, self.edit_blocks)
         if "<ins>" not in diff and "<del>" not in diff:
             return False
         tmpl = jinja2.Template(codecs.open(tmpl_path, "r", "utf8").read())
@@ -376,23 +796,97 @@ class Diff(BaseModel):
             new_time=self.new.created,
             diff=diff,
         )
-        codecs.open(self.html_path, "w", "utf8").write(html)
+        artifacts.write(self.id, self.html_name, html.encode("utf8"))
         return True
 
     def _generate_diff_images(self):
-        if os.path.isfile(self.screenshot_path):
+        if artifacts.exists(self.id, self.screenshot_name) and artifacts.exists(
+            self.id, self.thumbnail_name
+        ):
             return
+        if self.read_html() is None:
+            logging.warning("no html to take screenshots of for diff %s", self.id)
+            return
+        with metrics.timer("screenshot"):
+            self._take_screenshots()
 
-        logging.debug("creating image screenshot %s", self.screenshot_path)
+    def _take_screenshots(self):
+        logging.debug("creating image screenshot %s", self.screenshot_name)
+        browser = get_browser()
         browser.set_window_size(1400, 1000)
         uri = "file:///" + os.path.abspath(self.html_path)
         browser.get(uri)
-        time.sleep(5)  # give the page time to load
-        browser.save_screenshot(self.screenshot_path)
-        logging.debug("creating image thumbnail %s", self.thumbnail_path)
-        browser.set_window_size(800, 400)
-        browser.execute_script("clip()")
-        browser.save_screenshot(self.thumbnail_path)
+
+        # the page doesn't load anything else, so it is ready once it's
+        # loaded. where the thumbnail's paragraphs are is looked up now so
+        # that the thumbnail can be cut out of the same screenshot
+        clipped = clip(self.read_html()) or (None, None)
+        width, height, ratio, box = browser.execute_script(CLIP_BOX, *clipped)
+        if box and box[3] > height:
+            browser.set_window_size(1400, 1000 + int(box[3] - height) + 40)
+        png = browser.get_screenshot_as_png()
+
+        colors = config.get("screenshots.colors", 256)
+        viewport = (0, 0, width * ratio, height * ratio)
+        artifacts.write(
+            self.id, self.screenshot_name, images.crop(png, viewport, colors)
+        )
+        logging.debug("creating image thumbnail %s", self.thumbnail_name)
+        if box:
+            box = [v * ratio for v in box]
+        else:
+            box = (0, 0, width * ratio, width * ratio / 2)
+        artifacts.write(
+            self.id, self.thumbnail_name, images.thumbnail(png, box, colors=colors)
+        )
+
+
+class Host(BaseModel):
+    """
+    How well requests to a host have been going, for the circuit breaker.
+    """
+
+    name = TextField(primary_key=True)
+    failures = IntegerField(default=0)
+    backoff = IntegerField(default=0)
+    open_until = DateTimeField(null=True)
+
+    @staticmethod
+    def load(name):
+        h = Host.get_or_none(Host.name == name)
+        if h is None:
+            return None
+        return {
+            "failures": h.failures,
+            "backoff": h.backoff,
+            "open_until": h.open_until,
+        }
+
+    @staticmethod
+    def store(name, state):
+        # mysql always goes by the primary key, and won't be told which to use
+        mysql = isinstance(database.obj, MySQLDatabase)
+        Host.insert(name=name, **state).on_conflict(
+            conflict_target=None if mysql else [Host.name],
+            update=dict((getattr(Host, k), v) for k, v in state.items()),
+        ).execute()
+
+
+# the size of the viewport, and the box around the children of the diff
+# that the thumbnail shows, in css pixels
+CLIP_BOX = """
+var box = null;
+var diff = document.querySelector(".diff");
+if (diff && arguments[0] !== null) {
+  var children = diff.children;
+  var last = children.length - 1;
+  var first = children[Math.min(arguments[0], last)].getBoundingClientRect();
+  var end = children[Math.min(arguments[1], last)].getBoundingClientRect();
+  var d = diff.getBoundingClientRect();
+  box = [d.left, first.top + window.scrollY, d.right, end.bottom + window.scrollY];
+}
+return [window.innerWidth, window.innerHeight, window.devicePixelRatio, box];
+"""
 
 
 def setup_logging(log_file=True, log_console=False):
@@ -516,78 +1010,297 @@ def setup_db():
     database_handler = connect(database_url)
     database.initialize(database_handler)
     database.connect()
-    database.create_tables([Feed, Entry, FeedEntry, EntryVersion, Diff], safe=True)
+    # the indexes are only created once the migrations have added their
+    # columns, since sqlite will index a missing column as a string
+    models = [Feed, Entry, FeedEntry, EntryVersion, Diff, Host]
+    for model in models:
+        model._schema.create_table(safe=True)
+
+    migrator = SchemaMigrator.from_database(database_handler)
+    _migrate(migrator.add_index("entryversion", ("url",), False))
+    _migrate(migrator.add_column("diff", "edit_script", Diff.edit_script))
+    _migrate(migrator.add_column("entryversion", "minhash", EntryVersion.minhash))
+    # add_column also adds the index for indexed fields
+    _migrate(
+        migrator.add_column("entryversion", "content_hash", EntryVersion.content_hash)
+    )
+    _migrate(migrator.add_column("entry", "duplicate_of_id", Entry.duplicate_of))
+    _migrate(migrator.add_column("feedentry", "skipped", FeedEntry.skipped))
+    _migrate(
+        migrator.add_column("entry", "state", Entry.state),
+        migrator.add_column("entry", "unchanged_checks", Entry.unchanged_checks),
+    )
+    _migrate(
+        migrator.add_column("feedentry", "item_updated", FeedEntry.item_updated),
+        migrator.add_column("feedentry", "item_digest", FeedEntry.item_digest),
+    )
+    if _migrate(migrator.add_column("entry", "changes", Entry.changes)):
+        # the versions after the first one were all changes
+        versions = EntryVersion.select(fn.COUNT(EntryVersion.id) - 1).where(
+            EntryVersion.entry == Entry.id
+        )
+        Entry.update(changes=versions).where(
+            Entry.id.in_(EntryVersion.select(EntryVersion.entry))
+        ).execute()
+    if _migrate(migrator.add_column("entry", "next_check", Entry.next_check)):
+        # without this every entry from before would be due on the next run
+        entries = Entry.select(
+            Entry.id, Entry.created, Entry.checked, Entry.state, Entry.changes
+        ).where(Entry.checked.is_null(False))
+        for entry in entries:
+            entry.next_check = entry._next_check()
+        Entry.bulk_update(entries, fields=[Entry.next_check], batch_size=500)
+    _migrate(
+        migrator.add_column("entry", "latest_version_id", Entry.latest_version),
+        migrator.add_column("entry", "latest_title_hash", Entry.latest_title_hash),
+        migrator.add_column("entry", "latest_summary_hash", Entry.latest_summary_hash),
+    )
 
-    if isinstance(database_handler, SqliteDatabase):
-        try:
-            migrator = SqliteMigrator(database_handler)
-            migrate(migrator.add_index("entryversion", ("url",), False))
-        except OperationalError as e:
-            logging.debug(e)
+    for model in models:
+        model._schema.create_indexes(safe=True)
+
+
+def _migrate(*operations):
+    # a column or index that is already there shows up as a different error
+    # on each backend: OperationalError on sqlite and mysql, ProgrammingError
+    # on postgres
+    try:
+        migrate(*operations)
+        return True
+    except (OperationalError, ProgrammingError, InternalError) as e:
+        logging.debug(e)
+        return False
 
 
-def chromedriver_browser(executable_path, binary_location):
+def chromedriver_browser(executable_path, binary_location, block_external=True):
     options = ChromeOptions()
     options.binary_location = binary_location
     options.add_argument("--headless")
     options.add_argument("--disable-dev-shm-usage")
     options.add_argument("--no-sandbox")
+    if block_external:
+        # no host names resolve, so nothing outside the page can be loaded
+        options.add_argument("--host-resolver-rules=MAP * ~NOTFOUND")
     return webdriver.Chrome(executable_path=executable_path, options=options)
 
 
-def geckodriver_browser():
+def geckodriver_browser(block_external=True):
     opts = FirefoxOptions()
     opts.headless = True
+    if block_external:
+        # send everything to a proxy that isn't there, so nothing outside
+        # the page can be loaded
+        opts.set_preference("network.proxy.type", 1)
+        for scheme in ("http", "ssl"):
+            opts.set_preference("network.proxy.%s" % scheme, "127.0.0.1")
+            opts.set_preference("network.proxy.%s_port" % scheme, 9)
+        opts.set_preference("network.proxy.no_proxies_on", "")
+        opts.set_preference("network.proxy.allow_hijacking_localhost", True)
     return webdriver.Firefox(options=opts)
 
 
-def setup_browser(engine="geckodriver", executable_path=None, binary_location=""):
+def setup_browser(
+    engine="geckodriver", executable_path=None, binary_location="", block_external=True
+):
     global browser
 
+    check_browser(engine)
+
+    if engine == "chromedriver":
+        return chromedriver_browser(
+            engine if executable_path is None else executable_path,
+            binary_location,
+            block_external,
+        )
+
+    if engine == "geckodriver":
+        return geckodriver_browser(block_external)
+
+
+def check_browser(engine="geckodriver"):
     if engine not in ["chromedriver", "geckodriver"]:
         raise UnknownWebdriverError(engine)
 
     if not shutil.which(engine):
         sys.exit("Please install %s and make sure it is in your PATH." % engine)
 
-    if engine == "chromedriver":
-        return chromedriver_browser(
-            engine if executable_path is None else executable_path, binary_location
+
+def get_browser():
+    """
+    Returns the browser for taking screenshots, starting it the first time
+    it is needed, so that runs which never take a screenshot don't start one.
+    """
+    global browser
+    if browser is None:
+        browser = setup_browser(
+            config.get("webdriver.engine", "geckodriver"),
+            config.get("webdriver.executable_path"),
+            config.get("webdriver.binary_location"),
+            config.get("webdriver.block_external", True),
         )
+    return browser
 
-    if engine == "geckodriver":
-        return geckodriver_browser()
 
+def quit_browser():
+    global browser
+    if browser is not None:
+        browser.quit()
+        browser = None
+
+
+def setup_throttle():
+    # time_sleep is the old name for the delay between requests to a host
+    return HostThrottle(
+        delay=config.get("politeness.delay", config.get("time_sleep", 0)),
+        burst=config.get("politeness.burst", 1),
+        robots=config.get("politeness.robots", True) and not replaying(),
+        max_wait=config.get("politeness.max_wait", 60),
+        retry_after=config.get("politeness.retry_after", 60),
+        user_agent=UA,
+        fetch=http_client.get,
+        lookahead=config.get("politeness.lookahead", 100),
+    )
 
-def init(new_home, prompt=True):
-    global home, config, browser
+
+def setup_breaker():
+    return CircuitBreaker(
+        failures=config.get("circuit_breaker.failures", 5),
+        backoff=config.get("circuit_breaker.backoff", 600),
+        max_backoff=config.get("circuit_breaker.max_backoff", 86400),
+        load=Host.load,
+        save=Host.store,
+    )
+
+
+def setup_scheduler():
+    if not config.get("schedule.adaptive", False):
+        return None
+    return AdaptiveSchedule(
+        probability=config.get("schedule.probability", 0.5),
+        min_interval=config.get("schedule.min_interval", 15),
+        max_interval=config.get("schedule.max_interval", 7 * 24 * 60),
+        prior_hours=config.get("schedule.prior_hours", 24),
+        default_rate=config.get("schedule.default_rate", 0.05),
+    )
+
+
+def setup_canonicalizer():
+    return Canonicalizer(
+        strip_params=STRIP_PARAMS + tuple(config.get("canonical.strip_params", [])),
+        host_aliases=config.get("canonical.host_aliases", {}),
+        link_rel=config.get("canonical.link_rel", True),
+    )
+
+
+def setup_skip_rules():
+    # compiled up front so that a bad pattern is noticed at startup
+    feeds = config.get("feeds", []) or []
+    return (
+        dict((f["url"], SkipRule.from_config(f)) for f in feeds),
+        dict((f["url"], ItemRule.from_config(f)) for f in feeds),
+    )
+
+
+def setup_signal_backoffs():
+    feeds = config.get("feeds", []) or []
+    default = config.get("signal_backoff", 1)
+    return dict((f["url"], f.get("signal_backoff", default)) for f in feeds)
+
+
+def setup_artifacts():
+    root = home_path(config.get("artifacts.path", "diffs"))
+    backend = config.get("artifacts.backend", "local")
+    if backend not in ("local", "s3"):
+        raise ArtifactStoreError("unknown artifact store backend: %s" % backend)
+    if backend == "s3":
+        if not config.get("artifacts.s3.bucket"):
+            raise ArtifactStoreError("the s3 artifact store needs artifacts.s3.bucket")
+        return S3Store(
+            root,
+            config.get("artifacts.s3.bucket"),
+            prefix=config.get("artifacts.s3.prefix", ""),
+            endpoint_url=config.get("artifacts.s3.endpoint_url"),
+            region=config.get("artifacts.s3.region"),
+            access_key=config.get("artifacts.s3.access_key"),
+            secret_key=config.get("artifacts.s3.secret_key"),
+        )
+    return LocalStore(root, config.get("artifacts.pack_size", 256) * 1024 * 1024)
+
+
+def setup_http_client():
+    return HTTPClient(
+        user_agent=UA,
+        connect_timeout=config.get("http.connect_timeout", 10),
+        read_timeout=config.get("http.read_timeout", 60),
+        pool_size=config.get("http.pool_size", 10),
+        http2=config.get("http.http2", False),
+    )
+
+
+def setup_cache(replay=False):
+    if not (replay or config.get("cache.enabled", False)):
+        return None
+    return ResponseCache(
+        home_path(config.get("cache.path", "cache")),
+        max_size=config.get("cache.max_size", 512) * 1024 * 1024,
+        replay=replay,
+    )
+
+
+def setup_metrics():
+    m = Metrics()
+    if config.get("metrics.prometheus_file"):
+        m.sinks.append(PrometheusFileSink(home_path(config["metrics.prometheus_file"])))
+    if config.get("metrics.prometheus_port"):
+        m.sinks.append(
+            PrometheusHTTPSink(
+                m,
+                config["metrics.prometheus_port"],
+                config.get("metrics.prometheus_host", "127.0.0.1"),
+            )
+        )
+    if config.get("metrics.statsd"):
+        host, _, port = config["metrics.statsd"].partition(":")
+        m.sinks.append(StatsDSink(host, port or 8125))
+    if config.get("metrics.jsonl"):
+        m.sinks.append(JSONLinesSink(home_path(config["metrics.jsonl"])))
+    return m
+
+
+def replaying():
+    return response_cache is not None and response_cache.replay
+
+
+def init(new_home, prompt=True, replay=False):
+    global home, config, browser, throttle, http_client, response_cache, metrics
+    global canonicalizer, skip_rules, item_rules, artifacts, breaker, scheduler
+    global signal_backoffs
     home = new_home
     load_config(prompt)
+    metrics = setup_metrics()
+    canonicalizer = setup_canonicalizer()
+    skip_rules, item_rules = setup_skip_rules()
+    signal_backoffs = setup_signal_backoffs()
+    response_cache = setup_cache(replay)
+    http_client = setup_http_client()
+    throttle = setup_throttle()
+    breaker = setup_breaker()
+    scheduler = setup_scheduler()
+    # the browser is started by get_browser when a screenshot is needed
+    browser = None
     try:
-        # by defualt keep using geckodriver
-        engine = config.get("webdriver.engine", "geckodriver")
-        executable_path = config.get("webdriver.executable_path")
-        binary_location = config.get("webdriver.binary_location")
-        browser = setup_browser(engine, executable_path, binary_location)
         setup_logging(
             config.get("logger.file", True), config.get("logger.console", False)
         )
         setup_db()
     except RuntimeError as e:
         logging.error("Could not finish the setup", str(e))
+    # without somewhere to put the diffs there is no point in running, so
+    # a misconfigured artifact store is not caught here
+    artifacts = setup_artifacts()
 
 
-def main():
-    if len(sys.argv) == 1:
-        home = os.getcwd()
-    else:
-        home = sys.argv[1]
-
-    init(home)
-    start_time = datetime.utcnow()
-    logging.info("starting up with home=%s", home)
-    lang = config.get("lang", {})
-
+def setup_publishers():
     try:
         twitter_config = config.get("twitter", {})
         twitter_handler = TwitterHandler(
@@ -603,22 +1316,182 @@ def main():
     sendgrid_config = config.get("sendgrid", {})
     sendgrid_handler = SendgridHandler(sendgrid_config)
 
+    return twitter_handler, sendgrid_handler
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("home", nargs="?", default=os.getcwd())
+    parser.add_argument(
+        "--add", action="store_true", help="get the tokens for a twitter account"
+    )
+    parser.add_argument(
+        "--replay",
+        action="store_true",
+        help="check every entry against the response cache without using the network",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="URL",
+        help="profile checking one entry, or every entry of a configured feed",
+    )
+    parser.add_argument(
+        "--profiler",
+        choices=["cprofile", "sample"],
+        default="cprofile",
+        help="profile with cProfile or with a sampling profiler",
+    )
+    return parser.parse_args(args)
+
+
+def main():
+    options = parse_args()
+    if options.add:
+        get_auth_link_and_show_token()
+        return
+
+    home = options.home
+
+    # a run that is still going keeps the next one from starting, before it
+    # gets to migrate the database or bind the metrics port
+    os.makedirs(home, exist_ok=True)
+    lock = RunLock(os.path.join(home, "diffengine.lock"))
+    if not lock.acquire():
+        logging.warning("another run is still using %s, not starting", home)
+        return
+    try:
+        init(home, replay=options.replay)
+        if options.profile:
+            profile_url(options.profile, options.profiler)
+            quit_browser()
+        elif options.replay:
+            replay(options)
+        else:
+            run(options)
+    finally:
+        lock.release()
+
+
+def replay(options):
+    """
+    Runs against the response cache without changing anything: everything
+    written to the database is rolled back at the end, and the diff pages
+    and checkpoint go to a scratch directory that is removed afterwards.
+    """
+    with dry_run() as scratch:
+        run(options, Checkpoint(os.path.join(scratch, "checkpoint.json")))
+
+
+@contextlib.contextmanager
+def dry_run():
+    """
+    Lets the body of a with statement check entries without leaving a
+    trace: database writes are rolled back, nothing is sent to the
+    Internet Archive, and diff pages go to a scratch directory, which is
+    yielded and removed afterwards.
+    """
+    global artifacts, archiving
+    scratch = tempfile.mkdtemp()
+    real_artifacts = artifacts
+    artifacts = LocalStore(os.path.join(scratch, "diffs"))
+    archiving = False
+    try:
+        with database.atomic() as txn:
+            yield scratch
+            txn.rollback()
+    finally:
+        artifacts = real_artifacts
+        archiving = True
+        shutil.rmtree(scratch)
+
+
+def run(options, checkpoint=None):
+    """
+    Checks the feeds and their entries, stopping when the run's time
+    budget is used up. Entries are checked most overdue first, so the
+    ones that are left over are the first to be checked next time.
+    """
+    start_time = datetime.utcnow()
+    logging.info("starting up with home=%s", home)
+    lang = config.get("lang", {})
+    deadline = Deadline(config.get("run.budget"))
+    checkpoint = checkpoint or Checkpoint(home_path("checkpoint.json"))
+
+    if options.replay:
+        # nothing gets published when replaying
+        logging.info("replaying from the response cache in %s", response_cache.path)
+        twitter_handler = sendgrid_handler = None
+    else:
+        twitter_handler, sendgrid_handler = setup_publishers()
+
+    # only tweets need screenshots, so the browser is only needed for them
+    if twitter_handler and any(f.get("twitter") for f in config.get("feeds", [])):
+        check_browser(config.get("webdriver.engine", "geckodriver"))
+
     checked = skipped = new = 0
 
-    for f in config.get("feeds", []):
+    # old files are cleaned up while the entries are being checked
+    retention = None if options.replay else start_retention()
+
+    # start with the feed the last run stopped at, if it didn't get through
+    # them all. Only the order is carried over: every run fetches all of its
+    # feeds, and the entries a stopped run didn't get to are still the most
+    # overdue, so they are checked first anyway
+    feeds = []
+    for f in resume(config.get("feeds", []), checkpoint.load().get("next_feed")):
+        checkpoint.save(next_feed=f["url"])
+        if deadline.expired:
+            logging.warning("out of time, next run starts at feed %s", f["url"])
+            break
         feed, created = Feed.get_or_create(url=f["url"], name=f["name"])
         if created:
             logging.debug("created new feed for %s", f["url"])
 
         # get latest feed entries
-        feed.get_latest()
-
-        # get latest content for each entry
-        for entry in feed.entries:
-            result = process_entry(entry, f, twitter_handler, sendgrid_handler, lang)
-            skipped += result["skipped"]
-            checked += result["checked"]
-            new += result["new"]
+        feed.get_latest(_item_rule(f), _lifecycle(f).get("max_age"))
+
+        # how often the feed's entries change, for scheduling them
+        if scheduler:
+            scheduler.feed_rates[f["url"]] = scheduler.feed_rate(*_history(feed))
+
+        # only the entries that are due get checked, unless replaying
+        checkable = _checkable(feed, f)
+        due = checkable if options.replay else _due(checkable)
+        not_due = checkable.count() - due.count()
+        if not_due:
+            skipped += not_due
+            metrics.inc("diffengine_entries_total", not_due, result="skipped")
+        feeds.append((due, f))
+    else:
+        checkpoint.clear()
+
+    # get latest content for each entry, sharing the checks out between
+    # the feeds by their weight, and taking turns between hosts so that no
+    # site is hit too often while the others are kept waiting
+    rows = fair_share(
+        (f.get("weight", 1), islice(_feed_rows(due, f), f.get("max_checks")))
+        for due, f in feeds
+    )
+    for row, f in throttle.schedule(rows, lambda item: item[0].url):
+        if deadline.expired:
+            logging.warning("out of time, leaving the other entries for next run")
+            metrics.inc("diffengine_runs_out_of_time_total")
+            break
+        # don't wait on timeouts from a host that keeps failing
+        if breaker.open_for(row.url):
+            skipped += 1
+            metrics.inc("diffengine_entries_total", result="skipped")
+            continue
+        entry = Entry.get_by_id(row.id)
+        result = process_entry(
+            entry, f, twitter_handler, sendgrid_handler, lang, force=options.replay
+        )
+        skipped += result["skipped"]
+        checked += result["checked"]
+        new += result["new"]
+        for name, count in result.items():
+            if count:
+                metrics.inc("diffengine_entries_total", count, result=name)
 
     elapsed = datetime.utcnow() - start_time
     logging.info(
@@ -628,35 +1501,171 @@ def main():
         skipped,
         elapsed,
     )
+    logging.info("time spent: %s", _stage_times(metrics))
+
+    if retention:
+        finish_retention(retention)
+    metrics.close()
+
+    http_client.close()
+    if response_cache:
+        response_cache.close()
+    quit_browser()
+
+
+def start_retention():
+    """
+    Starts applying the retention policy to the files in the diffs
+    directory in a background thread, if there is a policy.
+    """
+    policy = config.get("retention", {}) or {}
+    if not policy:
+        return None
+    thread = threading.Thread(
+        target=sweep, args=(artifacts.root, dict(policy), artifacts.pack), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def finish_retention(thread):
+    """
+    Waits for the files to be swept and then prunes the database.
+    """
+    with metrics.timer("retention"):
+        thread.join()
+        days = config.get("retention.versions")
+        if days:
+            prune_versions(datetime.utcnow() - timedelta(days=days))
+        if config.get("retention.vacuum", False):
+            logging.info("vacuuming the database")
+            database.execute_sql("VACUUM")
+
+
+def prune_versions(before):
+    """
+    Deletes the versions created before a date, and the diffs between
+    them, keeping the latest version of every entry so that there is
+    always something to compare against.
+    """
+    latest = EntryVersion.select(fn.MAX(EntryVersion.id)).group_by(EntryVersion.entry)
+    doomed = EntryVersion.select(EntryVersion.id).where(
+        EntryVersion.created < before, EntryVersion.id.not_in(latest)
+    )
+    diffs = Diff.select().where(Diff.old.in_(doomed) | Diff.new.in_(doomed))
+    with database.atomic():
+        for diff in list(diffs):
+            diff.remove_files()
+            diff.delete_instance()
+        count = EntryVersion.delete().where(EntryVersion.id.in_(doomed)).execute()
+    logging.info("pruned %s versions from before %s", count, before)
+    return count
+
+
+def profile_url(url, profiler="cprofile"):
+    """
+    Checks a single entry, or every entry in a feed if the url is one of
+    the configured feeds, under a profiler. It runs dry, so nothing is
+    published, archived or kept in the database. The profile and a
+    breakdown of time per stage are written to the profiles directory in
+    the home directory.
+    """
+    global metrics
+    metrics = Metrics()
+    with dry_run():
+        return _profile_url(url, profiler)
+
+
+def _profile_url(url, profiler):
+    lang = config.get("lang", {})
+    feed_configs = dict((f["url"], f) for f in config.get("feeds", []))
+    if url in feed_configs:
+        f = feed_configs[url]
+        feed, created = Feed.get_or_create(url=f["url"], name=f["name"])
 
-    browser.quit()
+        def run():
+            feed.get_latest(_item_rule(f), _lifecycle(f).get("max_age"))
+            for entry in feed.entries:
+                process_entry(entry, f, lang=lang, force=True)
 
+    else:
+        entry, created = Entry.get_or_create(url=url)
+        f = next(
+            (feed_configs[e.url] for e in entry.feeds if e.url in feed_configs), {}
+        )
 
-def process_entry(entry, feed_config={}, twitter=None, sendgrid=None, lang={}):
+        def run():
+            process_entry(entry, f, lang=lang, force=True)
+
+    prefix = home_path(
+        "profiles/%s-%s"
+        % (datetime.utcnow().strftime("%Y%m%d%H%M%S"), re.sub(r"\W+", "-", url)[:80])
+    )
+    if not os.path.isdir(os.path.dirname(prefix)):
+        os.makedirs(os.path.dirname(prefix))
+
+    logging.info("profiling %s with %s", url, profiler)
+    start = time.perf_counter()
+    paths = profile(run, prefix, profiler)
+    elapsed = time.perf_counter() - start
+    write_stages(prefix + "-stages.txt", metrics.stages(), elapsed)
+    paths.append(prefix + "-stages.txt")
+
+    for path in paths:
+        logging.info("wrote %s", path)
+    return paths
+
+
+def process_entry(
+    entry, feed_config={}, twitter=None, sendgrid=None, lang={}, force=False
+):
     result = {"skipped": 0, "checked": 0, "new": 0}
-    if not entry.stale:
+    if not force and not entry.stale:
         result["skipped"] = 1
+        if entry.next_check is None:
+            # so that it isn't found to be due again on the next run
+            entry.next_check = entry._next_check(feed_config.get("url"))
+            entry.save()
     else:
         result["checked"] = 1
         try:
-            skip_pattern = feed_config.get("skip_pattern")
-            version = entry.get_latest(skip_pattern)
+            skip_pattern = _skip_rule(feed_config)
+            threshold = feed_config.get(
+                "similarity_threshold", config.get("similarity_threshold")
+            )
+            version = entry.get_latest(skip_pattern, threshold, feed_config.get("url"))
+            lifecycle = _lifecycle(feed_config)
+            entry.update_state(
+                lifecycle.get("cool_after"),
+                lifecycle.get("retire_after"),
+                feed_config.get("url"),
+            )
             if version:
                 result["new"] = 1
                 if version.diff:
+                    token = feed_config.get("twitter", {})
+                    publishers = [sendgrid] + ([twitter] if token else [])
                     try:
-                        token = feed_config.get("twitter", {})
-                        if token:
-                            twitter.tweet_diff(version.diff, token, lang)
+                        version.diff.prepare(
+                            set(a for p in publishers if p for a in p.artifacts)
+                        )
+                    except Exception as e:
+                        logging.error("unable to create artifacts for diff", e)
+                    try:
+                        if twitter and token:
+                            with metrics.timer("publish.twitter"):
+                                twitter.tweet_diff(version.diff, token, lang)
                     except TwitterError as e:
                         logging.warning("error occurred while trying to tweet", str(e))
                     except Exception as e:
                         logging.error("unknown error when tweeting diff", e)
 
                     try:
-                        sendgrid.publish_diff(
-                            version.diff, feed_config.get("sendgrid", {})
-                        )
+                        if sendgrid:
+                            with metrics.timer("publish.sendgrid"):
+                                sendgrid.publish_diff(
+                                    version.diff, feed_config.get("sendgrid", {})
+                                )
 
                     except SendgridConfigNotFoundError as e:
                         logging.error(
@@ -677,6 +1686,147 @@ def process_entry(entry, feed_config={}, twitter=None, sendgrid=None, lang={}):
     return result
 
 
+def _skip_rule(feed_config):
+    url = feed_config.get("url")
+    if url not in skip_rules:
+        skip_rules[url] = SkipRule.from_config(feed_config)
+    return skip_rules[url]
+
+
+def _item_rule(feed_config):
+    url = feed_config.get("url")
+    if url not in item_rules:
+        item_rules[url] = ItemRule.from_config(feed_config)
+    return item_rules[url]
+
+
+def _skipped_item(item_rule, item):
+    if not item_rule:
+        return None
+    return item_rule.match(
+        title=item.get("title", ""),
+        url=item.get("link", ""),
+        categories=[t.get("term") for t in item.get("tags", [])],
+    )
+
+
+def _item_updated(item):
+    t = item.get("updated_parsed") or item.get("published_parsed")
+    return datetime(*t[:6]) if t else None
+
+
+def _item_digest(item):
+    parts = [item.get("id", ""), item.get("title", ""), item.get("summary", "")]
+    parts.extend(c.get("value", "") for c in item.get("content", []))
+    return _sha1("\n".join(parts))
+
+
+def _checkable(feed, feed_config={}):
+    """
+    The entries of a feed that are still being checked, with only the
+    columns that are needed to schedule them. Entries older than the
+    feed's lifecycle max_age are retired first.
+    """
+    max_age = _lifecycle(feed_config).get("max_age")
+    if max_age:
+        cutoff = datetime.utcnow() - timedelta(days=max_age)
+        entry_ids = FeedEntry.select(FeedEntry.entry).where(FeedEntry.feed == feed)
+        count = (
+            Entry.update(state=RETIRED)
+            .where(
+                Entry.id.in_(entry_ids),
+                Entry.created < cutoff,
+                Entry.state != RETIRED,
+            )
+            .execute()
+        )
+        if count:
+            logging.info("retired %s entries older than %s", count, cutoff)
+    return (
+        Entry.select(Entry.id, Entry.url)
+        .join(FeedEntry)
+        .where(
+            FeedEntry.feed == feed,
+            Entry.duplicate_of.is_null(),
+            FeedEntry.skipped.is_null(),
+            Entry.state != RETIRED,
+        )
+    )
+
+
+def _due(query, now=None):
+    # entries that haven't been scheduled yet are due
+    now = now or datetime.utcnow()
+    return query.where(Entry.next_check.is_null() | (Entry.next_check <= now))
+
+
+def _scan(query):
+    """
+    Streams the rows of an entry query as light named tuples, rather than
+    building an Entry for every one of them. Entries that have never been
+    scheduled come first, newest first, and then the most overdue ones.
+
+    psycopg2 still fetches the whole result on the client, which is why the
+    rows are kept small. A server side cursor would be closed by the commits
+    that checking the entries makes, so each entry is loaded on its own when
+    it is checked instead.
+    """
+    return (
+        query.order_by(
+            Entry.next_check.is_null(False),
+            Entry.next_check,
+            Entry.created.desc(),
+        )
+        .namedtuples()
+        .iterator()
+    )
+
+
+def _history(feed):
+    """
+    How many times a feed's entries have changed, and for how many hours
+    they have been watched, added up by the database so that the cost
+    doesn't grow with the feed's history.
+    """
+    changes, seconds = (
+        Entry.select(
+            fn.SUM(Entry.changes), fn.SUM(_seconds(Entry.created, Entry.checked))
+        )
+        .join(FeedEntry)
+        .where(FeedEntry.feed == feed, Entry.duplicate_of.is_null())
+        .tuples()
+        .get()
+    )
+    return changes or 0, (seconds or 0) / HOUR
+
+
+def _seconds(start, end):
+    # the seconds between two datetime columns, which each database has its
+    # own way of working out
+    if isinstance(database.obj, MySQLDatabase):
+        return fn.TIMESTAMPDIFF(SQL("SECOND"), start, end)
+    if isinstance(database.obj, PostgresqlDatabase):
+        return fn.date_part("epoch", end - start)
+    return (fn.julianday(end) - fn.julianday(start)) * 86400
+
+
+def _feed_rows(query, feed_config):
+    for row in _scan(query):
+        yield row, feed_config
+
+
+def _lifecycle(feed_config):
+    # the feed's own lifecycle settings, falling back on the global ones
+    lifecycle = dict(config.get("lifecycle", {}) or {})
+    lifecycle.update(feed_config.get("lifecycle", {}) or {})
+    return lifecycle
+
+
+def _stage_times(m):
+    stages = sorted(m.stages().items(), key=lambda s: s[1][1], reverse=True)
+    return " ".join("%s=%.1fs/%s" % (name, secs, n) for name, (n, secs) in stages)
+
+
 def _dt(d):
     return d.strftime("%Y-%m-%d %H:%M:%S")
 
@@ -694,15 +1844,27 @@ def _normal(s):
     return s
 
 
-def _equal(s1, s2):
-    return _fingerprint(s1) == _fingerprint(s2)
-
+# pages shorter than this are not matched up with other entries by content
+MIN_DUPLICATE_LENGTH = 500
 
 punctuation = dict.fromkeys(
     i for i in range(sys.maxunicode) if unicodedata.category(chr(i)).startswith("P")
 )
 
 
+def _render_diff(old_html, new_html, edit_blocks):
+    # htmldiff2 is the default, but it gets slow on long articles, so they
+    # can be handed to the text diff once they pass diff.max_length. Only
+    # the text diff uses the edit script, so it is only worked out for that.
+    engine = config.get("diff.engine", "htmldiff2")
+    max_length = config.get("diff.max_length")
+    if max_length and max(len(old_html), len(new_html)) > max_length:
+        engine = "text"
+    if engine == "text":
+        return render_diff(old_html, new_html, edit_blocks())
+    return htmldiff2.render_html_diff(old_html, new_html)
+
+
 def _fingerprint(s):
     # make sure the string has been normalized, bleach everything, remove all
     # whitespace and punctuation to create a pseudo fingerprint for the text
@@ -714,29 +1876,40 @@ def _fingerprint(s):
     return s
 
 
-def _remove_utm(url):
-    u = urlparse(url)
-    q = parse_qs(u.query, keep_blank_values=True)
-    new_q = dict((k, v) for k, v in q.items() if not k.startswith("utm_"))
-    return urlunparse(
-        [u.scheme, u.netloc, u.path, u.params, urlencode(new_q, doseq=True), u.fragment]
-    )
+def _sha1(s):
+    return hashlib.sha1(s.encode("utf8")).hexdigest()
 
 
-def _get(url, allow_redirects=True):
-    return requests.get(
-        url, timeout=60, headers={"User-Agent": UA}, allow_redirects=allow_redirects
-    )
+def _get(url, allow_redirects=True, cache=True):
+    cache = response_cache if cache else None
+    if replaying():
+        resp = cache.get(url) if cache else None
+        if resp is None:
+            raise CacheMissError(url)
+        return resp
+
+    breaker.check(url)
+    throttle.wait(url)
+    headers = cache.validators(url) if cache else None
+    with metrics.timer("fetch"):
+        try:
+            resp = http_client.get(
+                url, allow_redirects=allow_redirects, headers=headers
+            )
+        except Exception:
+            breaker.failure(url)
+            raise
+    metrics.inc("diffengine_http_responses_total", status=resp.status_code)
+    if resp.status_code >= 500:
+        breaker.failure(url)
+    else:
+        breaker.success(url)
+    throttle.update(url, resp)
+    if cache:
+        resp = cache.update(url, resp)
+    return resp
 
 
 if __name__ == "__main__":
-    # Cli options
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--add", action="store_true")
-    options = parser.parse_args()
-
-    if options.add:
-        get_auth_link_and_show_token()
-    else:
-        main()
+    main()
     sys.exit("Finishing diffengine")
@@ -0,0 +1,233 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+from diffengine.exceptions.artifacts import ArtifactStoreError
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+
+class LocalStore:
+    """
+    Keeps artifacts like diff pages and screenshots on the local disk. Each
+    group of artifacts (the files for one diff) goes in a directory named
+    after a hash of the group, two levels deep, so no directory gets more
+    than a few thousand entries. Directories are only created once, and
+    writes go to a temporary file that is renamed into place.
+
+    Old artifacts can be packed into append-only pack files of up to
+    pack_size bytes, which keeps the number of files down; reads look in
+    the packs when an artifact isn't on disk anymore.
+    """
+
+    def __init__(self, root, pack_size=256 * 1024 * 1024):
+        self.root = root
+        self.pack_size = pack_size
+        self._dirs = set()
+        self._lock = threading.Lock()
+        self._index = None
+
+    def path(self, group, name):
+        digest = hashlib.sha1(str(group).encode("utf8")).hexdigest()
+        directory = os.path.join(self.root, digest[:2], digest[2:4])
+        if directory not in self._dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._dirs.add(directory)
+        return os.path.join(directory, name)
+
+    def write(self, group, name, data):
+        path = self.path(group, name)
+        tmp_path = "%s.%s.tmp" % (path, threading.get_ident())
+        with open(tmp_path, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+        return path
+
+    def read(self, group, name):
+        try:
+            with open(self.path(group, name), "rb") as fh:
+                return fh.read()
+        except FileNotFoundError:
+            return self._read_packed(name)
+
+    def exists(self, group, name):
+        return os.path.isfile(self.path(group, name)) or self._packed(name) is not None
+
+    def delete(self, group, name):
+        try:
+            os.remove(self.path(group, name))
+        except FileNotFoundError:
+            pass
+        if self._packed(name) is not None:
+            with self._lock:
+                self._db().execute("DELETE FROM packed WHERE name = ?", (name,))
+                self._db().commit()
+
+    def local_path(self, group, name):
+        """
+        Returns a path on disk for the artifact, for things like the browser
+        and the publishers that need a file.
+        """
+        path = self.path(group, name)
+        if not os.path.isfile(path):
+            data = self._read_packed(name)
+            if data is not None:
+                self.write(group, name, data)
+        return path
+
+    def pack(self, path):
+        """
+        Moves an artifact file into the current pack file. Artifact names
+        are unique, so the packs are indexed by file name.
+        """
+        name = os.path.basename(path)
+        with open(path, "rb") as fh:
+            data = fh.read()
+        with self._lock:
+            pack_path = self._current_pack(len(data))
+            with open(pack_path, "ab") as fh:
+                offset = fh.tell()
+                fh.write(data)
+                fh.flush()
+                os.fsync(fh.fileno())
+            self._db().execute(
+                "INSERT OR REPLACE INTO packed VALUES (?, ?, ?, ?)",
+                (name, os.path.basename(pack_path), offset, len(data)),
+            )
+            self._db().commit()
+        os.remove(path)
+
+    def close(self):
+        if self._index:
+            self._index.close()
+            self._index = None
+
+    def _packed(self, name):
+        if not os.path.isfile(os.path.join(self.root, "packs", "index.db")):
+            return None
+        with self._lock:
+            return (
+                self._db()
+                .execute(
+                    "SELECT pack, offset, length FROM packed WHERE name = ?", (name,)
+                )
+                .fetchone()
+            )
+
+    def _read_packed(self, name):
+        row = self._packed(name)
+        if row is None:
+            return None
+        pack, offset, length = row
+        with open(os.path.join(self.root, "packs", pack), "rb") as fh:
+            fh.seek(offset)
+            return fh.read(length)
+
+    def _current_pack(self, size):
+        packs = sorted(p for p in os.listdir(self._pack_dir()) if p.endswith(".pack"))
+        if packs:
+            path = os.path.join(self._pack_dir(), packs[-1])
+            if os.path.getsize(path) + size <= self.pack_size:
+                return path
+        return os.path.join(self._pack_dir(), "%06d.pack" % (len(packs) + 1))
+
+    def _pack_dir(self):
+        path = os.path.join(self.root, "packs")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _db(self):
+        if self._index is None:
+            self._index = sqlite3.connect(
+                os.path.join(self._pack_dir(), "index.db"), check_same_thread=False
+            )
+            self._index.execute("""
+                CREATE TABLE IF NOT EXISTS packed (
+                    name TEXT PRIMARY KEY,
+                    pack TEXT NOT NULL,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL
+                )
+                """)
+        return self._index
+
+
+class S3Store(LocalStore):
+    """
+    Keeps artifacts in an S3 compatible bucket (AWS, or something like
+    MinIO running locally), with the local disk as a cache for the files
+    that the browser and publishers need. Needs boto3 to be installed.
+    """
+
+    def __init__(
+        self,
+        root,
+        bucket,
+        prefix="",
+        endpoint_url=None,
+        region=None,
+        access_key=None,
+        secret_key=None,
+    ):
+        if boto3 is None:
+            raise ArtifactStoreError("the s3 artifact store needs boto3 installed")
+        super().__init__(root)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.s3 = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+        )
+
+    def write(self, group, name, data):
+        path = super().write(group, name, data)
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(group, name), Body=data)
+        return path
+
+    def read(self, group, name):
+        data = super().read(group, name)
+        if data is not None:
+            return data
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self._key(group, name))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return obj["Body"].read()
+
+    def exists(self, group, name):
+        if super().exists(group, name):
+            return True
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self._key(group, name))
+            return True
+        except Exception as e:
+            logging.debug("no %s in s3: %s", name, e)
+            return False
+
+    def delete(self, group, name):
+        super().delete(group, name)
+        self.s3.delete_object(Bucket=self.bucket, Key=self._key(group, name))
+
+    def local_path(self, group, name):
+        path = super().local_path(group, name)
+        if not os.path.isfile(path):
+            data = self.read(group, name)
+            if data is not None:
+                LocalStore.write(self, group, name, data)
+        return path
+
+    def pack(self, path):
+        # everything is already in the bucket, so the local copy can go
+        os.remove(path)
+
+    def _key(self, group, name):
+        key = "%s/%s" % (hashlib.sha1(str(group).encode("utf8")).hexdigest()[:4], name)
+        return "%s/%s" % (self.prefix, key) if self.prefix else key
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+import requests
+
+from requests.structures import CaseInsensitiveDict
+
+# only the headers that diffengine or a conditional request will look at
+KEEP_HEADERS = ("Content-Type", "Content-Location", "ETag", "Last-Modified")
+
+
+class ResponseCache:
+    """
+    An on-disk cache of HTTP responses. Bodies are kept zlib compressed in
+    files named after a hash of the url, and a small SQLite index (read
+    through a memory map) remembers each response's validators, size and
+    when it was last used, so that the least recently used bodies can be
+    evicted once the cache grows past max_size bytes.
+
+    In replay mode nothing is fetched from the network and every request
+    has to be answered from the cache.
+    """
+
+    def __init__(self, path, max_size=512 * 1024 * 1024, replay=False):
+        self.path = path
+        self.max_size = max_size
+        self.replay = replay
+        os.makedirs(path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(path, "index.db"))
+        self.db.execute("PRAGMA mmap_size = %d" % (64 * 1024 * 1024))
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS response (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                final_url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                encoding TEXT,
+                headers TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            )
+            """)
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed)"
+        )
+        self.db.commit()
+
+    def validators(self, url):
+        """
+        Returns the headers for a conditional request for the url, if a
+        cached response has an ETag or Last-Modified.
+        """
+        row = self._row(url)
+        if not row:
+            return None
+        headers = json.loads(row[4])
+        validators = {}
+        if headers.get("ETag"):
+            validators["If-None-Match"] = headers["ETag"]
+        if headers.get("Last-Modified"):
+            validators["If-Modified-Since"] = headers["Last-Modified"]
+        return validators or None
+
+    def get(self, url):
+        row = self._row(url)
+        if not row:
+            return None
+        key = _key(url)
+        try:
+            with open(self._body_path(key), "rb") as fh:
+                body = zlib.decompress(fh.read())
+        except (OSError, zlib.error) as e:
+            logging.warning("dropping unreadable cached response for %s: %s", url, e)
+            self._delete(key)
+            return None
+        self.db.execute(
+            "UPDATE response SET accessed = ? WHERE key = ?", (time.time(), key)
+        )
+        self.db.commit()
+
+        final_url, status, encoding, headers = row[1:5]
+        resp = requests.Response()
+        resp.url = final_url
+        resp.status_code = status
+        resp.encoding = encoding
+        resp.headers = CaseInsensitiveDict(json.loads(headers))
+        resp._content = body
+        return resp
+
+    def update(self, url, resp):
+        """
+        Stores a fresh response, or swaps a 304 Not Modified for the cached
+        response it refers to. The response to use is returned.
+        """
+        if resp.status_code == 304:
+            cached = self.get(url)
+            if cached is not None:
+                logging.debug("using cached response for %s", url)
+                return cached
+        elif resp.status_code == 200:
+            self.put(url, resp)
+        return resp
+
+    def put(self, url, resp):
+        key = _key(url)
+        body = zlib.compress(resp.content)
+        path = self._body_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(body)
+        os.replace(tmp_path, path)
+
+        headers = dict((h, resp.headers[h]) for h in KEEP_HEADERS if h in resp.headers)
+        self.db.execute(
+            "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                url,
+                resp.url or url,
+                resp.status_code,
+                resp.encoding,
+                json.dumps(headers),
+                len(body),
+                time.time(),
+            ),
+        )
+        self.db.commit()
+        self.evict()
+
+    def size(self):
+        return self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM response"
+        ).fetchone()[0]
+
+    def evict(self):
+        """
+        Removes the least recently used responses until the cache is back
+        under its size limit.
+        """
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return
+        rows = self.db.execute(
+            "SELECT key, size FROM response ORDER BY accessed"
+        ).fetchall()
+        doomed = []
+        for key, size in rows:
+            if excess <= 0:
+                break
+            doomed.append(key)
+            excess -= size
+        for key in doomed:
+            self._delete(key)
+        logging.debug("evicted %s responses from the cache", len(doomed))
+
+    def close(self):
+        self.db.close()
+
+    def _row(self, url):
+        return self.db.execute(
+            "SELECT key, final_url, status, encoding, headers FROM response WHERE key = ?",
+            (_key(url),),
+        ).fetchone()
+
+    def _delete(self, key):
+        try:
+            os.remove(self._body_path(key))
+        except FileNotFoundError:
+            pass
+        self.db.execute("DELETE FROM response WHERE key = ?", (key,))
+        self.db.commit()
+
+    def _body_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".z")
+
+
+def _key(url):
+    return hashlib.sha1(url.encode("utf8")).hexdigest()
@@ -0,0 +1,108 @@
+import fnmatch
+import re
+
+from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlunparse
+
+# query parameters that only track where a click came from
+STRIP_PARAMS = (
+    "utm_*",
+    "fbclid",
+    "gclid",
+    "dclid",
+    "msclkid",
+    "mc_cid",
+    "mc_eid",
+    "igshid",
+    "_ga",
+)
+
+LINK = re.compile(r"<link\b[^>]*>", re.IGNORECASE)
+ATTR = re.compile(r"""([\w-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""")
+
+
+class Canonicalizer:
+    """
+    Works out the canonical form of an article url, so that the same page
+    reached through tracking links, AMP or syndicated copies or another
+    hostname ends up as a single entry.
+
+    strip_params are glob patterns for query parameters to remove, and
+    host_aliases maps hostnames to the hostname to use in their place. When
+    link_rel is set, a page's <link rel="canonical"> is trusted as well.
+    """
+
+    def __init__(self, strip_params=STRIP_PARAMS, host_aliases={}, link_rel=True):
+        self.strip_params = list(strip_params)
+        self.host_aliases = dict(
+            (k.lower(), v.lower()) for k, v in host_aliases.items()
+        )
+        self.link_rel = link_rel
+
+    def url(self, url):
+        u = urlparse(url.strip())
+        netloc = u.netloc.lower()
+        host, sep, port = netloc.partition(":")
+        host = self.host_aliases.get(host, host)
+        if (u.scheme, port) in (("http", "80"), ("https", "443")):
+            sep = port = ""
+        query = [
+            (k, v)
+            for k, v in parse_qsl(u.query, keep_blank_values=True)
+            if not self._strip(k)
+        ]
+        return urlunparse(
+            [
+                u.scheme.lower(),
+                host + sep + port,
+                u.path or "/",
+                u.params,
+                urlencode(query),
+                "",
+            ]
+        )
+
+    def page_url(self, url, html):
+        """
+        Returns the canonical url for a fetched page, using the page's own
+        <link rel="canonical"> when there is one.
+        """
+        if self.link_rel:
+            link = canonical_link(html)
+            if link:
+                link = urljoin(url, link)
+                if urlparse(link).scheme in ("http", "https"):
+                    return self.url(link)
+        return self.url(url)
+
+    def _strip(self, param):
+        return any(fnmatch.fnmatchcase(param, p) for p in self.strip_params)
+
+
+def canonical_link(html):
+    """
+    Returns the href of the first <link rel="canonical"> in the html.
+    """
+    end = html.lower().find("</head>")
+    if end != -1:
+        html = html[:end]
+    for tag in LINK.findall(html):
+        attrs = dict(
+            (m.group(1).lower(), m.group(2) or m.group(3) or m.group(4) or "")
+            for m in ATTR.finditer(tag)
+        )
+        if "canonical" in attrs.get("rel", "").lower().split() and attrs.get("href"):
+            return attrs["href"].strip()
+    return None
+
+
+def front_page(url, page_url):
+    """
+    Returns True if url looks like the front page of a site or of one of its
+    sections rather than an article: the root of its host, or a parent of
+    page_url, as when an article's rel=canonical points at its section.
+    """
+    u, p = urlparse(url), urlparse(page_url)
+    path = u.path.rstrip("/")
+    if not path:
+        return True
+    return u.netloc == p.netloc and p.path.startswith(path + "/")
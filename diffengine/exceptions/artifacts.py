@@ -0,0 +1,10 @@
+class ArtifactStoreError(RuntimeError):
+    """Exception raised if the artifact store can't be set up
+
+    Attributes:
+        message -- what went wrong
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
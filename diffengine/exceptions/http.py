@@ -0,0 +1,41 @@
+class HostError(RuntimeError):
+    pass
+
+
+class HostBackoffError(HostError):
+    """Exception raised when a host asked us to wait longer than we are willing to
+
+    Attributes:
+        host -- the host that is being backed off
+        seconds -- how long until the host can be requested again
+    """
+
+    def __init__(self, host, seconds):
+        self.host = host
+        self.seconds = seconds
+        self.message = "backing off from %s for another %.0fs" % (host, seconds)
+        super().__init__(self.message)
+
+
+class CacheMissError(HostError):
+    """Exception raised when replaying and a url is not in the response cache"""
+
+    def __init__(self, url):
+        self.url = url
+        self.message = "no cached response for %s" % url
+        super().__init__(self.message)
+
+
+class HostUnavailableError(HostError):
+    """Exception raised when the circuit breaker for a failing host is open
+
+    Attributes:
+        host -- the host that is failing
+        seconds -- how long until the host will be tried again
+    """
+
+    def __init__(self, host, seconds):
+        self.host = host
+        self.seconds = seconds
+        self.message = "%s keeps failing, trying again in %.0fs" % (host, seconds)
+        super().__init__(self.message)
@@ -0,0 +1,57 @@
+import io
+
+from PIL import Image
+
+THUMBNAIL_SIZE = (800, 400)
+
+
+def crop(png, box, colors=None):
+    """
+    Crops a PNG to a (left, top, right, bottom) box. If colors is given
+    the image is reduced to a palette of that many colors, which makes it
+    a lot smaller and loses next to nothing for screenshots of text.
+    """
+    image = Image.open(io.BytesIO(png))
+    return _save(image.crop(_fit(box, image.size)), colors)
+
+
+def thumbnail(png, box, size=THUMBNAIL_SIZE, padding=20, colors=None):
+    """
+    Makes a thumbnail from the part of a screenshot inside box: it is
+    scaled to the thumbnail's width and cut to its height, keeping the top
+    and padding the bottom with white if it's too short.
+    """
+    image = Image.open(io.BytesIO(png)).convert("RGB")
+    left, top, right, bottom = box
+    box = (left - padding, top - padding, right + padding, bottom + padding)
+    region = image.crop(_fit(box, image.size))
+
+    width, height = size
+    scale = width / region.width
+    scaled = region.resize(
+        (width, max(1, round(region.height * scale))), Image.Resampling.LANCZOS
+    )
+    thumb = Image.new("RGB", size, "white")
+    thumb.paste(scaled.crop((0, 0, width, min(height, scaled.height))), (0, 0))
+    return _save(thumb, colors)
+
+
+def _fit(box, size):
+    left, top, right, bottom = (int(round(v)) for v in box)
+    width, height = size
+    return (
+        max(0, left),
+        max(0, top),
+        min(width, max(left + 1, right)),
+        min(height, max(top + 1, bottom)),
+    )
+
+
+def _save(image, colors=None):
+    if colors:
+        image = image.convert("RGB").quantize(
+            colors=colors, method=Image.Quantize.FASTOCTREE
+        )
+    out = io.BytesIO()
+    image.save(out, "PNG", optimize=True)
+    return out.getvalue()
@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = "diffengine_stage_seconds"
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class Metrics:
+    """
+    Counters and histograms for a run. Every observation is handed to the
+    configured sinks as it happens, and the totals can be rendered in the
+    Prometheus text format at any point.
+    """
+
+    def __init__(self, sinks=[]):
+        self.sinks = list(sinks)
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for sink in self.sinks:
+            sink.inc(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """
+        Times the body of a with statement as a stage of the run. Stages
+        can be nested, archiving includes fetching for example, so only
+        the time that isn't spent in a nested stage is counted, which keeps
+        the stage totals from adding up to more than the run took.
+        """
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            self.observe(STAGE_SECONDS, elapsed - nested, stage=stage, **labels)
+
+    def stages(self):
+        """
+        Returns the number of times each stage ran and its total seconds.
+        """
+        totals = {}
+        for (name, labels), h in self.histograms.items():
+            if name != STAGE_SECONDS:
+                continue
+            stage = dict(labels)["stage"]
+            count, seconds = totals.get(stage, (0, 0.0))
+            totals[stage] = (count + h.count, seconds + h.sum)
+        return totals
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name in sorted(set(k[0] for k in self.counters)):
+                lines.append("# TYPE %s counter" % name)
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append("%s%s %s" % (name, _format(labels), value))
+            for name in sorted(set(k[0] for k in self.histograms)):
+                lines.append("# TYPE %s histogram" % name)
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(h.buckets, h.counts):
+                        le = labels + (("le", str(bound)),)
+                        lines.append("%s_bucket%s %s" % (name, _format(le), count))
+                    le = labels + (("le", "+Inf"),)
+                    lines.append("%s_bucket%s %s" % (name, _format(le), h.count))
+                    lines.append("%s_sum%s %s" % (name, _format(labels), h.sum))
+                    lines.append("%s_count%s %s" % (name, _format(labels), h.count))
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        for sink in self.sinks:
+            try:
+                sink.close(self)
+            except Exception as e:
+                logging.error("unable to close metrics sink %s: %s", sink, e)
+
+
+class Sink:
+    def inc(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        pass
+
+    def close(self, metrics):
+        pass
+
+
+class PrometheusFileSink(Sink):
+    """
+    Writes the totals for the run to a file in the Prometheus text format
+    when the run is over, for node_exporter's textfile collector.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def close(self, metrics):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(metrics.prometheus())
+        # rename so the collector never sees a half written file
+        os.replace(tmp_path, self.path)
+
+
+class PrometheusHTTPSink(Sink):
+    """
+    Serves the running totals at /metrics while diffengine is running.
+    """
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode("utf8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self, metrics):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class StatsDSink(Sink):
+    """
+    Sends every counter and timing to a StatsD server over UDP as it happens.
+    """
+
+    def __init__(self, host="localhost", port=8125, prefix="diffengine"):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def inc(self, name, value, labels):
+        self._send("%s:%s|c" % (self._name(name, labels), value))
+
+    def observe(self, name, value, labels):
+        self._send("%s:%.3f|ms" % (self._name(name, labels), value * 1000))
+
+    def close(self, metrics):
+        self.socket.close()
+
+    def _name(self, name, labels):
+        name = name.replace("diffengine_", "")
+        parts = [self.prefix, name] + [str(v) for k, v in _labels(labels)]
+        return ".".join(p.replace(".", "_").replace(":", "_") for p in parts if p)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line.encode("utf8"), self.address)
+        except OSError as e:
+            logging.debug("unable to send to statsd: %s", e)
+
+
+class JSONLinesSink(Sink):
+    """
+    Appends every counter and timing to a file as a line of JSON.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def inc(self, name, value, labels):
+        self._write("counter", name, value, labels)
+
+    def observe(self, name, value, labels):
+        self._write("histogram", name, value, labels)
+
+    def close(self, metrics):
+        self.file.close()
+
+    def _write(self, kind, name, value, labels):
+        record = {"time": time.time(), "type": kind, "name": name, "value": value}
+        record.update(labels)
+        self.file.write(json.dumps(record) + "\n")
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, v.replace('"', '\\"')) for k, v in labels)
@@ -0,0 +1,300 @@
+import logging
+import time
+import urllib.robotparser
+
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from diffengine.exceptions.http import HostBackoffError, HostUnavailableError
+
+_END = object()
+
+
+def host(url):
+    return urlparse(url).netloc.lower()
+
+
+class TokenBucket:
+    """
+    A token bucket for a single host. Tokens trickle in at `rate` per
+    second up to `capacity`, and each request spends one. A rate of 0
+    means the host is not rate limited at all.
+    """
+
+    def __init__(self, rate=0, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        if self.rate > 0:
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        else:
+            self.tokens = self.capacity
+        self.updated = now
+
+    def ready_in(self, now=None):
+        """
+        Returns how many seconds to wait until a request can be made.
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        wait = 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds, now=None):
+        now = time.monotonic() if now is None else now
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class HostThrottle:
+    """
+    Keeps requests to each host politely spaced out, while letting requests
+    to different hosts go ahead without waiting on each other. The spacing
+    for a host is the configured delay, or its robots.txt Crawl-delay if
+    that is larger, and a 429 or 503 with a Retry-After header will hold
+    the host back for as long as it asks.
+    """
+
+    def __init__(
+        self,
+        delay=0,
+        burst=1,
+        robots=False,
+        max_wait=60,
+        retry_after=60,
+        user_agent="*",
+        fetch=None,
+        lookahead=100,
+    ):
+        self.delay = delay
+        self.burst = burst
+        self.robots = robots and fetch is not None
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.user_agent = user_agent
+        self.fetch = fetch
+        self.lookahead = lookahead
+        self.buckets = {}
+
+    def bucket(self, url):
+        h = host(url)
+        b = self.buckets.get(h)
+        if b is None:
+            delay = self.delay
+            if self.robots:
+                delay = max(delay, self._robots_delay(url) or 0)
+            b = TokenBucket(1 / delay if delay > 0 else 0, self.burst)
+            self.buckets[h] = b
+            if self.robots:
+                # fetching robots.txt was a request to the host too
+                b.consume()
+        return b
+
+    def ready_in(self, url):
+        return self.bucket(url).ready_in()
+
+    def wait(self, url):
+        """
+        Sleeps until a request to the url's host can be made. If that is
+        further away than max_wait a HostBackoffError is raised instead.
+        """
+        b = self.bucket(url)
+        seconds = b.ready_in()
+        if seconds > self.max_wait:
+            raise HostBackoffError(host(url), seconds)
+        if seconds > 0:
+            logging.debug("waiting %.2fs before fetching %s", seconds, url)
+            time.sleep(seconds)
+        b.consume()
+
+    def update(self, url, resp):
+        """
+        Looks at the response for a url and backs off from its host if the
+        server is telling us to slow down.
+        """
+        if resp.status_code not in (429, 503):
+            return
+        seconds = _retry_after(resp.headers.get("Retry-After"))
+        if seconds is None:
+            if resp.status_code != 429:
+                return
+            seconds = self.retry_after
+        logging.warning(
+            "got %s from %s, backing off for %.0fs",
+            resp.status_code,
+            host(url),
+            seconds,
+        )
+        self.bucket(url).block(seconds)
+
+    def schedule(self, items, url=lambda item: item):
+        """
+        Reorders items so that requests to different hosts are interleaved.
+        Items are read lazily, lookahead at a time, and are taken in the
+        order they come in unless their host has to wait, in which case the
+        first item for a host that can be requested sooner goes ahead.
+        Hosts that are held back for longer than max_wait are dropped for
+        this run.
+        """
+        items = iter(items)
+        window = []
+        dropped = OrderedDict()
+        try:
+            while True:
+                while len(window) < self.lookahead:
+                    item = next(items, _END)
+                    if item is _END:
+                        break
+                    window.append(item)
+                if not window:
+                    return
+
+                waits = {}
+                best = None
+                for i, item in enumerate(window):
+                    h = host(url(item))
+                    if h not in waits:
+                        waits[h] = self.ready_in(url(item))
+                        if best is None or waits[h] < waits[host(url(window[best]))]:
+                            best = i
+                        if waits[h] <= 0:
+                            break
+
+                h = host(url(window[best]))
+                if waits[h] > self.max_wait:
+                    # nothing for this host can go this run
+                    kept = [item for item in window if host(url(item)) != h]
+                    dropped[h] = dropped.get(h, 0) + len(window) - len(kept)
+                    window = kept
+                    continue
+                yield window.pop(best)
+        finally:
+            for h, count in dropped.items():
+                logging.warning("skipping %s entries from %s for this run", count, h)
+
+    def _robots_delay(self, url):
+        u = urlparse(url)
+        robots_url = "%s://%s/robots.txt" % (u.scheme, u.netloc)
+        try:
+            resp = self.fetch(robots_url)
+        except Exception as e:
+            logging.debug("unable to fetch %s: %s", robots_url, str(e))
+            return None
+        if resp.status_code != 200:
+            return None
+
+        parser = urllib.robotparser.RobotFileParser(robots_url)
+        parser.parse(resp.text.splitlines())
+        delay = parser.crawl_delay(self.user_agent)
+        rate = parser.request_rate(self.user_agent)
+        if rate and rate.requests:
+            delay = max(delay or 0, rate.seconds / rate.requests)
+        if delay:
+            logging.debug("using crawl delay of %ss for %s", delay, u.netloc)
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Stops wasting requests (and timeouts) on hosts that keep failing. After
+    `failures` failed requests in a row the circuit for a host opens, and
+    its requests are refused for `backoff` seconds. After that one request
+    is let through as a probe: if it works the circuit closes again, and if
+    it fails the circuit opens for twice as long, up to max_backoff. A
+    failures of 0 turns the breaker off.
+
+    load and save are called with a host to keep its state between runs.
+    """
+
+    def __init__(
+        self, failures=5, backoff=600, max_backoff=86400, load=None, save=None
+    ):
+        self.failures = failures
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.load = load
+        self.save = save
+        self.hosts = {}
+
+    def state(self, url):
+        h = host(url)
+        if h not in self.hosts:
+            state = self.load(h) if self.load else None
+            self.hosts[h] = state or {"failures": 0, "backoff": 0, "open_until": None}
+        return self.hosts[h]
+
+    def open_for(self, url, now=None):
+        """
+        Returns how many seconds the circuit for the url's host stays open,
+        or 0 if requests can be made.
+        """
+        if not self.failures:
+            return 0
+        open_until = self.state(url)["open_until"]
+        if open_until is None:
+            return 0
+        now = now or datetime.utcnow()
+        return max(0, (open_until - now).total_seconds())
+
+    def check(self, url, now=None):
+        seconds = self.open_for(url, now)
+        if seconds > 0:
+            raise HostUnavailableError(host(url), seconds)
+
+    def success(self, url):
+        state = self.state(url)
+        if state["failures"] or state["open_until"]:
+            if state["open_until"]:
+                logging.info("%s is working again", host(url))
+            state.update(failures=0, backoff=0, open_until=None)
+            self._save(url, state)
+
+    def failure(self, url, now=None):
+        state = self.state(url)
+        state["failures"] += 1
+        if self.failures and state["failures"] >= self.failures:
+            # a failed probe keeps the circuit open for longer
+            if state["open_until"]:
+                backoff = min(self.max_backoff, state["backoff"] * 2)
+            else:
+                backoff = self.backoff
+            now = now or datetime.utcnow()
+            state.update(backoff=backoff, open_until=now + timedelta(seconds=backoff))
+            logging.warning(
+                "%s failed %s times in a row, not trying it again for %ss",
+                host(url),
+                state["failures"],
+                backoff,
+            )
+        self._save(url, state)
+
+    def _save(self, url, state):
+        if self.save:
+            self.save(host(url), state)
+
+
+def _retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0, (when - datetime.now(timezone.utc)).total_seconds())
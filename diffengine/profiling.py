@@ -0,0 +1,103 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+
+
+class Sampler:
+    """
+    A sampling profiler for the thread that starts it. The thread's stack
+    is looked at every interval seconds and the samples are written in the
+    collapsed stack format that flamegraph.pl and speedscope understand.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(target,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, path):
+        with open(path, "w") as fh:
+            for stack, count in self.samples.most_common():
+                fh.write("%s %s\n" % (stack, count))
+
+    def _run(self, target):
+        while not self._stop.is_set():
+            frame = sys._current_frames().get(target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    "%s (%s:%s)"
+                    % (
+                        code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno,
+                    )
+                )
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+
+def profile(func, prefix, profiler="cprofile"):
+    """
+    Runs func under the chosen profiler and writes the results to files
+    starting with prefix. The paths of the files are returned.
+    """
+    if profiler == "sample":
+        sampler = Sampler()
+        sampler.start()
+        try:
+            func()
+        finally:
+            sampler.stop()
+        path = prefix + ".folded"
+        sampler.write(path)
+        return [path]
+
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        func()
+    finally:
+        prof.disable()
+
+    path = prefix + ".prof"
+    prof.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(prof, stream=out).sort_stats("cumulative").print_stats(50)
+    with open(prefix + "-pstats.txt", "w") as fh:
+        fh.write(out.getvalue())
+    return [path, prefix + "-pstats.txt"]
+
+
+def write_stages(path, stages, elapsed):
+    """
+    Writes a breakdown of where the time went, from Metrics.stages().
+    """
+    with open(path, "w") as fh:
+        fh.write("%-20s %8s %10s %7s\n" % ("stage", "count", "seconds", "share"))
+        for name, (count, seconds) in sorted(
+            stages.items(), key=lambda s: s[1][1], reverse=True
+        ):
+            share = seconds / elapsed * 100 if elapsed else 0
+            fh.write("%-20s %8s %10.3f %6.1f%%\n" % (name, count, seconds, share))
+        fh.write("%-20s %8s %10.3f\n" % ("elapsed", "", elapsed))
@@ -0,0 +1,94 @@
+import gzip
+import logging
+import os
+import shutil
+import time
+
+DAY = 24 * 60 * 60
+
+
+def sweep(root, policy, pack=None, now=None):
+    """
+    Applies the file retention policy to the diffs under root, going by
+    when each file was last modified. policy is a dict that can have:
+
+        thumbnails:  days to keep -thumb.png files
+        screenshots: days to keep the other .png files
+        html:        days to keep .html files, gzipped or not
+        gzip_html:   days after which .html files are gzipped
+        pack_html:   days after which html files are handed to pack
+
+    Policies that are missing or empty keep files forever. The number of
+    files removed, gzipped and packed are returned.
+    """
+    now = now or time.time()
+    counts = {"removed": 0, "gzipped": 0, "packed": 0}
+    if not os.path.isdir(root):
+        return counts
+
+    for path, age in _files(root, now):
+        name = os.path.basename(path)
+        if name.endswith("-thumb.png"):
+            keep = policy.get("thumbnails")
+        elif name.endswith(".png"):
+            keep = policy.get("screenshots")
+        elif name.endswith(".html") or name.endswith(".html.gz"):
+            keep = policy.get("html")
+        else:
+            continue
+
+        if keep is not None and age > keep * DAY:
+            _remove(path)
+            counts["removed"] += 1
+        elif (
+            pack
+            and ".html" in name
+            and policy.get("pack_html") is not None
+            and age > policy["pack_html"] * DAY
+        ):
+            pack(path)
+            counts["packed"] += 1
+        elif (
+            name.endswith(".html")
+            and policy.get("gzip_html") is not None
+            and age > policy["gzip_html"] * DAY
+        ):
+            gzip_file(path)
+            counts["gzipped"] += 1
+
+    logging.info(
+        "retention removed %s, gzipped %s and packed %s files in %s",
+        counts["removed"],
+        counts["gzipped"],
+        counts["packed"],
+        root,
+    )
+    return counts
+
+
+def gzip_file(path):
+    """
+    Replaces a file with a gzipped copy that keeps its modification time.
+    """
+    stat = os.stat(path)
+    tmp_path = path + ".gz.tmp"
+    with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+    os.replace(tmp_path, path + ".gz")
+    os.remove(path)
+
+
+def _files(root, now):
+    for f in os.scandir(root):
+        if f.is_dir() and f.name != "packs":
+            yield from _files(f.path, now)
+        elif f.is_file():
+            yield f.path, now - f.stat().st_mtime
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,147 @@
+import heapq
+import json
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class RunLock:
+    """
+    Makes sure only one run uses a home directory at a time, so that a run
+    that overruns isn't joined by the next one. The lock is held with
+    flock, so it goes away with the process even if the run is killed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fh = None
+
+    def acquire(self):
+        """
+        Takes the lock, returning False if another run has it.
+        """
+        if fcntl is None:
+            # no flock, so a lock file left by a killed run has to be
+            # removed by hand
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                return False
+            self.fh = os.fdopen(fd, "w")
+        else:
+            self.fh = open(self.path, "a+")
+            try:
+                fcntl.flock(self.fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self.fh.close()
+                self.fh = None
+                return False
+            self.fh.seek(0)
+            self.fh.truncate()
+        self.fh.write(str(os.getpid()))
+        self.fh.flush()
+        return True
+
+    def release(self):
+        if self.fh is None:
+            return
+        if fcntl is None:
+            self.fh.close()
+            os.remove(self.path)
+        else:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+            self.fh.close()
+        self.fh = None
+
+
+class Checkpoint:
+    """
+    Remembers how far a run got, in a small json file, so that the next
+    run can pick up where a run that ran out of time or was killed left
+    off.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logging.warning("ignoring unreadable checkpoint %s: %s", self.path, e)
+            return {}
+
+    def save(self, **state):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(state, fh)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Deadline:
+    """
+    A wall clock budget for a run. A budget of None never runs out.
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.started = time.monotonic()
+
+    def left(self):
+        if self.seconds is None:
+            return float("inf")
+        return self.seconds - (time.monotonic() - self.started)
+
+    @property
+    def expired(self):
+        return self.left() <= 0
+
+
+def resume(feeds, next_url):
+    """
+    Reorders the feed configs so that the feed a run stopped at comes
+    first, followed by the ones after it and then the ones before it.
+    """
+    urls = [f["url"] for f in feeds]
+    if next_url not in urls:
+        return list(feeds)
+    i = urls.index(next_url)
+    return feeds[i:] + feeds[:i]
+
+
+def fair_share(streams):
+    """
+    Merges (weight, items) streams with weighted fair queueing, so that a
+    stream with twice the weight gets twice as many turns. Each item taken
+    from a stream moves its virtual clock on by 1/weight, and the next item
+    always comes from the stream whose clock is furthest behind, with ties
+    going to the stream that was listed first.
+    """
+    heap = []
+    for i, (weight, items) in enumerate(streams):
+        if weight <= 0:
+            raise ValueError("stream weights have to be positive: %s" % weight)
+        heap.append((1 / weight, i, weight, iter(items)))
+    heapq.heapify(heap)
+    while heap:
+        clock, i, weight, items = heapq.heappop(heap)
+        try:
+            item = next(items)
+        except StopIteration:
+            continue
+        yield item
+        heapq.heappush(heap, (clock + 1 / weight, i, weight, items))
@@ -0,0 +1,69 @@
+import math
+
+from datetime import timedelta
+
+HOUR = 60 * 60
+
+
+def change_rate(changes, hours, prior_rate, prior_hours):
+    """
+    Estimates how many times an hour a page changes, treating its changes
+    as a Poisson process. The prior is what is expected of a page before
+    anything is known about it, and counts as prior_hours of observation,
+    so a page that has only been watched for a short while is mostly
+    judged by the prior, and one that has been watched for a long time by
+    its own history. A page that stops changing has its rate fall off as
+    the time it has been watched grows.
+    """
+    return (prior_rate * prior_hours + changes) / (prior_hours + max(0, hours))
+
+
+class AdaptiveSchedule:
+    """
+    Works out when to check an entry again from how often it, and the
+    other entries in its feed, have changed. The next check is put where
+    the chance of the entry having changed reaches probability, so that
+    entries that change a lot are checked often and ones that don't are
+    left alone, between min_interval and max_interval minutes.
+
+    feed_rates holds the change rate of each feed by url, which is used
+    as the prior for the feed's entries; default_rate is used for feeds
+    that don't have one yet.
+    """
+
+    def __init__(
+        self,
+        probability=0.5,
+        min_interval=15,
+        max_interval=7 * 24 * 60,
+        prior_hours=24,
+        default_rate=0.05,
+    ):
+        self.probability = probability
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.prior_hours = prior_hours
+        self.default_rate = default_rate
+        self.feed_rates = {}
+
+    def feed_rate(self, changes, hours):
+        """
+        Estimates the change rate of a feed from how many times its entries
+        have changed in all, and the hours they have been watched for.
+        """
+        return change_rate(changes, hours, self.default_rate, self.prior_hours)
+
+    def interval(self, changes, observed, feed=None):
+        """
+        Returns how long to wait before checking an entry that changed
+        changes times in the observed timedelta.
+        """
+        prior = self.feed_rates.get(feed, self.default_rate)
+        rate = change_rate(
+            changes, observed.total_seconds() / HOUR, prior, self.prior_hours
+        )
+        # the chance of at least one change in t hours is 1 - e^(-rate * t)
+        minutes = 60 * -math.log(1 - self.probability) / rate if rate > 0 else None
+        if minutes is None or minutes > self.max_interval:
+            minutes = self.max_interval
+        return timedelta(minutes=max(self.min_interval, minutes))
@@ -11,6 +11,8 @@ from diffengine.exceptions.sendgrid import (
 
 
 class SendgridHandler:
+    # what diffs need to have for them to be emailed
+    artifacts = ("html",)
     api_token = None
     sender = None
     recipients = None
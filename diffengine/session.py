@@ -0,0 +1,110 @@
+import logging
+import requests
+
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from diffengine.politeness import host
+
+try:
+    import brotli  # noqa: F401 -- urllib3 decodes br when this is installed
+except ImportError:
+    brotli = None
+
+# sites that meter articles do it with cookies, so none are kept
+NO_COOKIES = DefaultCookiePolicy(allowed_domains=[])
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class HTTPClient:
+    """
+    A shared HTTP client that keeps one pooled session per host, so that
+    feeds, articles and archive requests to the same site reuse keep-alive
+    connections instead of doing a DNS lookup and TLS handshake each time.
+    Compressed responses are requested, and HTTP/2 is used when asked for
+    and httpx is installed. Cookies are never kept, so that sites that
+    meter articles with them see every request as a new visitor.
+    """
+
+    def __init__(
+        self,
+        user_agent=None,
+        connect_timeout=10,
+        read_timeout=60,
+        pool_size=10,
+        http2=False,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.headers = {
+            "Accept-Encoding": "gzip, deflate, br" if brotli else "gzip, deflate"
+        }
+        if user_agent:
+            self.headers["User-Agent"] = user_agent
+        if http2 and httpx is None:
+            logging.warning("http2 needs httpx[http2] to be installed, using http/1.1")
+        self.http2 = http2 and httpx is not None
+        self.sessions = {}
+
+    def session(self, url):
+        h = host(url)
+        s = self.sessions.get(h)
+        if s is None:
+            s = self._new_session()
+            self.sessions[h] = s
+        return s
+
+    def get(self, url, allow_redirects=True, headers=None):
+        s = self.session(url)
+        if self.http2:
+            connect, read = self.timeout
+            resp = s.get(
+                url,
+                headers=headers,
+                follow_redirects=allow_redirects,
+                timeout=httpx.Timeout(read, connect=connect),
+            )
+            return _to_requests_response(resp)
+        return s.get(
+            url, headers=headers, timeout=self.timeout, allow_redirects=allow_redirects
+        )
+
+    def close(self):
+        for s in self.sessions.values():
+            s.close()
+        self.sessions = {}
+
+    def _new_session(self):
+        if self.http2:
+            limits = httpx.Limits(max_connections=self.pool_size)
+            return httpx.Client(
+                http2=True,
+                headers=self.headers,
+                limits=limits,
+                cookies=CookieJar(NO_COOKIES),
+            )
+        s = requests.Session()
+        s.cookies.set_policy(NO_COOKIES)
+        s.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        return s
+
+
+def _to_requests_response(resp):
+    # the rest of diffengine expects requests responses, so httpx ones
+    # are converted rather than leaking a second response type around
+    r = requests.Response()
+    r.status_code = resp.status_code
+    r.headers = CaseInsensitiveDict(resp.headers)
+    r.url = str(resp.url)
+    r.encoding = resp.encoding
+    r.reason = resp.reason_phrase
+    r._content = resp.content
+    return r
@@ -0,0 +1,59 @@
+import hashlib
+import random
+import re
+
+# the largest Mersenne prime that fits in 64 bits, for the universal hashes
+PRIME = (1 << 61) - 1
+
+NUM_PERM = 64
+SHINGLE_SIZE = 4
+
+TAG = re.compile(r"<[^>]+>")
+WORD = re.compile(r"\w+")
+
+# a fixed seed, since signatures are stored and compared across runs
+_random = random.Random(20200320)
+PERMUTATIONS = [
+    (_random.randrange(1, PRIME), _random.randrange(0, PRIME)) for i in range(NUM_PERM)
+]
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """
+    Returns the set of runs of size words in the text, ignoring markup,
+    punctuation and case.
+    """
+    words = WORD.findall(TAG.sub(" ", text).lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return set(" ".join(words[i : i + size]) for i in range(len(words) - size + 1))
+
+
+def signature(text):
+    """
+    Returns the MinHash signature of the text's shingles as a hex string.
+    The share of positions two signatures agree on estimates how similar
+    the two texts are.
+    """
+    hashes = [_hash(s) for s in shingles(text)]
+    return "".join(
+        "%016x" % min((a * h + b) % PRIME for h in hashes) for a, b in PERMUTATIONS
+    )
+
+
+def similarity(sig1, sig2):
+    """
+    Returns the estimated Jaccard similarity, from 0 to 1, of the texts
+    that two signatures came from.
+    """
+    if not sig1 or len(sig1) != len(sig2):
+        return 0.0
+    same = sum(
+        1 for i in range(0, len(sig1), 16) if sig1[i : i + 16] == sig2[i : i + 16]
+    )
+    return same / (len(sig1) / 16)
+
+
+def _hash(shingle):
+    digest = hashlib.blake2b(shingle.encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
@@ -1,5 +1,7 @@
+import functools
 import logging
 import re
+import sys
 import unicodedata
 
 
@@ -77,6 +79,106 @@ def to_utf8(text):
 
 
 def matches(pattern, text):
-    nfkd_form = unicodedata.normalize("NFKD", text.upper())
-    normalized = u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
-    return re.search(pattern, normalized, re.I | re.M) is not None
+    return re.search(pattern, normalize(text), re.I | re.M) is not None
+
+
+@functools.lru_cache(maxsize=64)
+def normalize(text):
+    """
+    Upper cases the text and strips its accents for matching. The result is
+    cached, since a title and summary get matched against several rules.
+    """
+    if text.isascii():
+        return text.upper()
+    return unicodedata.normalize("NFKD", text.upper()).translate(_combining())
+
+
+@functools.lru_cache(maxsize=None)
+def _combining():
+    # built the first time it's needed, since it takes a moment
+    return dict.fromkeys(
+        i for i in range(sys.maxunicode) if unicodedata.combining(chr(i))
+    )
+
+
+class SkipRule:
+    """
+    A feed's skip_pattern and skip_keywords, compiled once. The keywords
+    are combined into a single trie shaped regular expression, so that the
+    text is scanned once for all of them instead of once per keyword.
+    """
+
+    def __init__(self, pattern=None, keywords=()):
+        self.pattern = re.compile(pattern, re.I | re.M) if pattern else None
+        self.keywords = re.compile(keyword_pattern(keywords)) if keywords else None
+
+    @classmethod
+    def from_config(cls, feed_config):
+        pattern = feed_config.get("skip_pattern")
+        keywords = feed_config.get("skip_keywords") or []
+        if not (pattern or keywords):
+            return None
+        return cls(pattern, keywords)
+
+    def matches(self, *texts):
+        for text in texts:
+            normalized = normalize(text)
+            if self.pattern and self.pattern.search(normalized):
+                return True
+            if self.keywords and self.keywords.search(normalized):
+                return True
+        return False
+
+
+def keyword_pattern(keywords):
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for c in normalize(keyword):
+            node = node.setdefault(c, {})
+        node[""] = {}
+    return _trie_pattern(trie)
+
+
+def _trie_pattern(node):
+    branches = [re.escape(c) + _trie_pattern(node[c]) for c in sorted(node) if c]
+    if not branches:
+        return ""
+    if len(branches) == 1 and "" not in node:
+        return branches[0]
+    return "(?:%s)%s" % ("|".join(branches), "?" if "" in node else "")
+
+
+class ItemRule:
+    """
+    A feed's skip_items rules, for skipping items using what the feed says
+    about them so that their pages are never fetched. Each of title, url
+    and category can be a regular expression or a list of keywords.
+    """
+
+    fields = ("title", "url", "category")
+
+    def __init__(self, title=None, url=None, category=None):
+        self.rules = {}
+        for name, value in zip(self.fields, (title, url, category)):
+            if isinstance(value, str):
+                self.rules[name] = SkipRule(value)
+            elif value:
+                self.rules[name] = SkipRule(keywords=value)
+
+    @classmethod
+    def from_config(cls, feed_config):
+        rules = feed_config.get("skip_items") or {}
+        if not any(rules.get(name) for name in cls.fields):
+            return None
+        return cls(*(rules.get(name) for name in cls.fields))
+
+    def match(self, title="", url="", categories=()):
+        """
+        Returns the name of the first rule that matches the item, or None.
+        """
+        values = {"title": [title], "url": [url], "category": categories}
+        for name, rule in self.rules.items():
+            if rule.matches(*[v for v in values[name] if v]):
+                return name
+        return None
@@ -0,0 +1,353 @@
+import bisect
+import difflib
+import re
+
+import lxml.html
+
+# tags, words with the whitespace that follows them, and leftover whitespace
+TOKEN = re.compile(r"<[^>]+>|[^\s<]+\s*|\s+")
+
+# a word that ends a sentence, allowing for closing quotes and brackets
+SENTENCE_END = re.compile(r"[.!?][\"'”’)\]]*\s*$")
+
+
+def tokenize(html):
+    return TOKEN.findall(html)
+
+
+def opcodes(old_tokens, new_tokens):
+    """
+    Returns difflib style opcodes that turn old_tokens into new_tokens.
+    Sentences are compared first, and only the sentences that changed are
+    compared word by word, which keeps long articles with a few edits
+    cheap to diff. Whitespace at the end of a word is not significant.
+    """
+    old_sentences = _sentences(old_tokens)
+    new_sentences = _sentences(new_tokens)
+    sentence_ops = _opcodes(
+        [s[2] for s in old_sentences], [s[2] for s in new_sentences]
+    )
+
+    ops = []
+    for tag, i1, i2, j1, j2 in sentence_ops:
+        a1, a2 = _span(old_sentences, i1, i2, len(old_tokens))
+        b1, b2 = _span(new_sentences, j1, j2, len(new_tokens))
+        if tag in ("insert", "delete"):
+            ops.append((tag, a1, a2, b1, b2))
+            continue
+        old_keys = [_key(t) for t in old_tokens[a1:a2]]
+        new_keys = [_key(t) for t in new_tokens[b1:b2]]
+        # sentence keys leave out whitespace between tags, so sentences that
+        # look the same can still differ token by token
+        if tag == "equal" and old_keys == new_keys:
+            ops.append((tag, a1, a2, b1, b2))
+            continue
+        word_ops = _opcodes(old_keys, new_keys)
+        for tag, k1, k2, l1, l2 in word_ops:
+            ops.append((tag, a1 + k1, a1 + k2, b1 + l1, b1 + l2))
+    return _merge(ops)
+
+
+def render(old_tokens, new_tokens, ops):
+    """
+    Renders opcodes as html in the same style as htmldiff2, with deleted
+    words in <del> and inserted words in <ins>. Markup is taken from the
+    new version so that the result is well formed.
+    """
+    out = ['<div class="diff">']
+    for tag, i1, i2, j1, j2 in ops:
+        if tag == "equal":
+            out.extend(new_tokens[j1:j2])
+            continue
+        if i2 > i1:
+            out.append(_wrap("del", old_tokens[i1:i2], keep_tags=False))
+        if j2 > j1:
+            out.append(_wrap("ins", new_tokens[j1:j2], keep_tags=True))
+    out.append("</div>")
+    return "".join(out)
+
+
+def render_diff(old_html, new_html, blocks=None):
+    """
+    Renders the diff between two versions of an article. If the matching
+    blocks between their tokens are already known they are used instead
+    of diffing the html again, as long as they do match.
+    """
+    old_tokens = tokenize(old_html)
+    new_tokens = tokenize(new_html)
+    if blocks is None or not matches(old_tokens, new_tokens, blocks):
+        ops = opcodes(old_tokens, new_tokens)
+    else:
+        ops = to_opcodes(blocks)
+    return render(old_tokens, new_tokens, ops)
+
+
+def clip(page):
+    """
+    Finds the paragraph with the most changed text in a rendered diff page,
+    for the thumbnail. The positions of the first and last child of the
+    diff to show, the one holding that paragraph and the ones either side
+    of it, are returned, or None if nothing changed in any paragraph.
+    """
+    doc = lxml.html.document_fromstring(page)
+    diffs = doc.find_class("diff")
+    if not diffs:
+        return None
+
+    best = None
+    largest = 0
+    for p in diffs[0].iter("p"):
+        length = sum(len(c.text_content()) for c in p if c.tag in ("del", "ins"))
+        if length > largest:
+            best, largest = p, length
+    if best is None:
+        return None
+
+    # the paragraph may be inside an <ins> or <del>
+    while best.getparent() is not diffs[0]:
+        best = best.getparent()
+    children = [c for c in diffs[0] if isinstance(c.tag, str)]
+    i = children.index(best)
+    return max(0, i - 1), min(len(children) - 1, i + 1)
+
+
+def matching_blocks(ops):
+    """
+    Returns the equal runs in opcodes as difflib style (i, j, n) matching
+    blocks, ending with a (len(old), len(new), 0) block. This is all that
+    is needed to get the opcodes back, so it is what gets stored.
+    """
+    blocks = [(i1, j1, i2 - i1) for tag, i1, i2, j1, j2 in ops if tag == "equal"]
+    end = (ops[-1][2], ops[-1][4]) if ops else (0, 0)
+    blocks.append(end + (0,))
+    return blocks
+
+
+def matches(old_tokens, new_tokens, blocks):
+    """
+    Checks that matching blocks fit the tokens, which edit scripts saved by
+    an older version of diffengine, or for different html, may not.
+    """
+    if not blocks or blocks[-1] != (len(old_tokens), len(new_tokens), 0):
+        return False
+    i = j = 0
+    for ai, bj, size in blocks:
+        if ai < i or bj < j:
+            return False
+        for k in range(size):
+            if _key(old_tokens[ai + k]) != _key(new_tokens[bj + k]):
+                return False
+        i, j = ai + size, bj + size
+    return True
+
+
+def compose(first, second):
+    """
+    Combines the matching blocks from version a to b and from b to c into
+    the matching blocks from a to c: a token of c matches a token of a when
+    it matched a token of b that in turn matched the token of a.
+    """
+    blocks = []
+    k = 0
+    for i, j, n in first[:-1]:
+        while k < len(second) - 1 and second[k][0] + second[k][2] <= j:
+            k += 1
+        m = k
+        while m < len(second) - 1 and second[m][0] < j + n:
+            b, c, size = second[m]
+            start = max(j, b)
+            end = min(j + n, b + size)
+            if start < end:
+                _add_block(blocks, (i + start - j, c + start - b, end - start))
+            m += 1
+    blocks.append((first[-1][0], second[-1][1], 0))
+    return blocks
+
+
+def to_opcodes(blocks):
+    """
+    Turns matching blocks back into opcodes.
+    """
+    ops = []
+    i = j = 0
+    for ai, bj, size in blocks:
+        if i < ai and j < bj:
+            ops.append(("replace", i, ai, j, bj))
+        elif i < ai:
+            ops.append(("delete", i, ai, j, bj))
+        elif j < bj:
+            ops.append(("insert", i, ai, j, bj))
+        if size:
+            ops.append(("equal", ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    return _merge(ops)
+
+
+def _opcodes(a, b):
+    blocks = []
+    _match(a, 0, len(a), b, 0, len(b), blocks)
+    blocks.append((len(a), len(b), 0))
+    return to_opcodes(blocks)
+
+
+def _add_block(blocks, block):
+    if blocks:
+        i, j, n = blocks[-1]
+        if i + n == block[0] and j + n == block[1]:
+            blocks[-1] = (i, j, n + block[2])
+            return
+    blocks.append(block)
+
+
+def _match(a, alo, ahi, b, blo, bhi, blocks, depth=0):
+    # a patience diff: items that occur exactly once on each side are
+    # matched up in order and used as anchors, and the gaps between them
+    # are diffed the same way. difflib only gets used for what is left,
+    # which keeps this close to linear for text that is mostly unchanged.
+    while alo < ahi and blo < bhi and a[alo] == b[blo]:
+        blocks.append((alo, blo, 1))
+        alo += 1
+        blo += 1
+    suffix = 0
+    while (
+        alo < ahi - suffix
+        and blo < bhi - suffix
+        and a[ahi - 1 - suffix] == b[bhi - 1 - suffix]
+    ):
+        suffix += 1
+    ahi -= suffix
+    bhi -= suffix
+
+    anchors = _anchors(a, alo, ahi, b, blo, bhi) if depth < 50 else []
+    if anchors:
+        for i, j in anchors:
+            _match(a, alo, i, b, blo, j, blocks, depth + 1)
+            blocks.append((i, j, 1))
+            alo, blo = i + 1, j + 1
+        _match(a, alo, ahi, b, blo, bhi, blocks, depth + 1)
+    elif alo < ahi and blo < bhi:
+        matcher = difflib.SequenceMatcher(None, a[alo:ahi], b[blo:bhi], False)
+        for i, j, size in matcher.get_matching_blocks()[:-1]:
+            blocks.append((alo + i, blo + j, size))
+
+    for k in range(suffix):
+        blocks.append((ahi + k, bhi + k, 1))
+
+
+def _anchors(a, alo, ahi, b, blo, bhi):
+    old = {}
+    for i in range(alo, ahi):
+        old[a[i]] = i if a[i] not in old else None
+    new = {}
+    for j in range(blo, bhi):
+        new[b[j]] = j if b[j] not in new else None
+    pairs = sorted(
+        (i, new[item])
+        for item, i in old.items()
+        if i is not None and new.get(item) is not None
+    )
+
+    # the longest run of pairs that is in order on both sides
+    tails = []
+    tail_positions = []
+    links = []
+    for n, (i, j) in enumerate(pairs):
+        k = bisect.bisect_left(tail_positions, j)
+        links.append(tails[k - 1] if k > 0 else None)
+        if k == len(tails):
+            tails.append(n)
+            tail_positions.append(j)
+        else:
+            tails[k] = n
+            tail_positions[k] = j
+    anchors = []
+    n = tails[-1] if tails else None
+    while n is not None:
+        anchors.append(pairs[n])
+        n = links[n]
+    return anchors[::-1]
+
+
+def _key(token):
+    return token.rstrip()
+
+
+def _sentences(tokens):
+    # (start, end, key) for every sentence, with opening tags kept with the
+    # sentence they start and closing tags with the sentence they end, so
+    # that common tags like <p> don't end up as sentences of their own
+    sentences = []
+    start = 0
+    for i, token in enumerate(tokens):
+        if token.startswith("</"):
+            end = True
+        elif token.startswith("<"):
+            if _words(tokens, start, i) and not tokens[i - 1].startswith("<"):
+                sentences.append(_sentence(tokens, start, i))
+                start = i
+            end = False
+        elif not token.strip():
+            end = False
+        else:
+            end = SENTENCE_END.search(token) and not (
+                i + 1 < len(tokens) and tokens[i + 1].startswith("</")
+            )
+        if end:
+            sentences.append(_sentence(tokens, start, i + 1))
+            start = i + 1
+    if start < len(tokens):
+        sentences.append(_sentence(tokens, start, len(tokens)))
+    return sentences
+
+
+def _sentence(tokens, start, end):
+    return (start, end, tuple(k for k in map(_key, tokens[start:end]) if k))
+
+
+def _words(tokens, start, end):
+    return any(t.strip() for t in tokens[start:end])
+
+
+def _span(sentences, i1, i2, length):
+    if i1 == i2:
+        pos = sentences[i1][0] if i1 < len(sentences) else length
+        return pos, pos
+    return sentences[i1][0], sentences[i2 - 1][1]
+
+
+def _merge(ops):
+    merged = []
+    for op in ops:
+        if op[1] == op[2] and op[3] == op[4]:
+            continue
+        if merged and merged[-1][0] == op[0]:
+            last = merged.pop()
+            op = (op[0], last[1], op[2], last[3], op[4])
+        merged.append(op)
+    return merged
+
+
+def _wrap(tag, tokens, keep_tags):
+    out = []
+    text = []
+
+    def flush():
+        if not text:
+            return
+        words = "".join(text)
+        stripped = words.rstrip()
+        if stripped.strip():
+            out.append("<%s>%s</%s>%s" % (tag, stripped, tag, words[len(stripped) :]))
+        elif keep_tags:
+            out.append(words)
+        text.clear()
+
+    for token in tokens:
+        if token.startswith("<"):
+            flush()
+            if keep_tags:
+                out.append(token)
+        else:
+            text.append(token)
+    flush()
+    return "".join(out)
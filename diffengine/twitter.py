@@ -14,6 +14,8 @@ from diffengine.exceptions.twitter import (
 
 
 class TwitterHandler:
+    # what diffs need to have for them to be tweeted
+    artifacts = ("html", "thumbnail")
     consumer_key = None
     consumer_secret = None
 
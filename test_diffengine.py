@@ -1,12 +1,30 @@
+import bleach
+import email
+import htmldiff2
+import io
+import json
 import logging
 import os
+import random
 import re
+import readability
 from envyaml import EnvYAML
 
 import setup
+import diffengine
 import pytest
+import requests
 import shutil
-
+import socket
+import sqlite3
+import tempfile
+import time
+import urllib.request
+
+from datetime import datetime, timedelta
+from itertools import islice
+from PIL import Image
+from playhouse.test_utils import count_queries
 from selenium import webdriver
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
@@ -17,7 +35,12 @@ from diffengine import (
     Feed,
     EntryVersion,
     Entry,
+    ACTIVE,
+    COOLING,
+    RETIRED,
+    Diff,
     FeedEntry,
+    Host,
     home_path,
     load_config,
     setup_browser,
@@ -28,13 +51,49 @@ from diffengine import (
     SendgridHandler,
     _fingerprint,
 )
-from diffengine.text import build_text, to_utf8, matches
+from diffengine.text import (
+    ItemRule,
+    SkipRule,
+    build_text,
+    keyword_pattern,
+    matches,
+    to_utf8,
+)
+from diffengine.politeness import CircuitBreaker, HostThrottle, TokenBucket
+from diffengine.session import HTTPClient
+from diffengine.artifacts import LocalStore
+from diffengine.images import crop, thumbnail
+from diffengine.cache import ResponseCache
+from diffengine import retention
+from diffengine.retention import sweep
+from diffengine.schedule import AdaptiveSchedule, change_rate
+from diffengine.runs import Checkpoint, Deadline, RunLock, fair_share, resume
+from diffengine.canonical import Canonicalizer, canonical_link, front_page
+from diffengine.metrics import (
+    JSONLinesSink,
+    Metrics,
+    PrometheusHTTPSink,
+    StatsDSink,
+)
+from diffengine.similarity import signature, similarity
+from diffengine.textdiff import (
+    clip,
+    compose,
+    matching_blocks,
+    opcodes,
+    render_diff,
+    to_opcodes,
+    tokenize,
+)
+from diffengine.profiling import profile
 from diffengine.utils import generate_config
+from diffengine.exceptions.artifacts import ArtifactStoreError
 from diffengine.exceptions.sendgrid import (
     SendgridConfigNotFoundError,
     AlreadyEmailedError,
     SendgridArchiveUrlNotFoundError,
 )
+from diffengine.exceptions.http import HostBackoffError, HostUnavailableError
 from diffengine.exceptions.twitter import (
     TwitterConfigNotFoundError,
     TokenNotFoundError,
@@ -80,6 +139,14 @@ class FeedTest(TestCase):
         self.entry = self.feed.entries[0]
         self.version = self.entry.get_latest()
 
+    def edit(self, entry, version, summary):
+        # the entry keeps hashes of its latest version, which have to follow
+        # the edit for it to be compared against what is fetched
+        version.summary = summary
+        version.save()
+        entry._point_to(version)
+        entry.save()
+
     def test_feed(self):
         assert self.feed.created
         assert len(self.feed.entries) == 10
@@ -93,8 +160,7 @@ class FeedTest(TestCase):
         v1 = e.versions[0]
 
         # remove some characters from the version
-        v1.summary = v1.summary[0:-20]
-        v1.save()
+        self.edit(e, v1, v1.summary[0:-20])
 
         v2 = e.get_latest()
         assert type(v2) == EntryVersion
@@ -124,8 +190,7 @@ class FeedTest(TestCase):
         v1 = e.versions[-1]
         parts = v1.summary.split()
         parts.insert(2, "<br>   \n")
-        v1.summary = " ".join(parts)
-        v1.save()
+        self.edit(e, v1, " ".join(parts))
 
         v2 = e.get_latest()
         assert v2 is None
@@ -166,8 +231,7 @@ class FeedTest(TestCase):
         v1 = e.versions[-1]
 
         # add some whitespace
-        v1.summary = v1.summary + "\n\n    "
-        v1.save()
+        self.edit(e, v1, v1.summary + "\n\n    ")
 
         # whitespace should not count when diffing
         v2 = e.get_latest()
@@ -180,8 +244,7 @@ class FeedTest(TestCase):
         v1 = e.versions[0]
 
         # remove some characters from the version
-        v1.summary = v1.summary[0:-20]
-        v1.save()
+        self.edit(e, v1, v1.summary[0:-20])
 
         v2 = e.get_latest()
 
@@ -387,6 +450,24 @@ class EntryTest(TestCase):
         assert result["new"] == 1
         sendgrid.publish_diff.assert_called_once()
 
+    def test_publishers_declare_artifacts(self):
+        twitter = MagicMock(artifacts=("html", "thumbnail"))
+        sendgrid = MagicMock(artifacts=("html",))
+
+        diff = MagicMock()
+        version = MagicMock(diff=diff)
+        entry = MagicMock()
+        type(entry).stale = PropertyMock(return_value=True)
+        entry.get_latest = MagicMock(return_value=version)
+
+        process_entry(entry, {}, twitter, sendgrid)
+        diff.prepare.assert_called_once_with({"html"})
+
+        diff.reset_mock()
+        token = {"access_token": "test", "access_token_secret": "test"}
+        process_entry(entry, {"twitter": token}, twitter, sendgrid)
+        diff.prepare.assert_called_once_with({"html", "thumbnail"})
+
 
 class TwitterHandlerTest(TestCase):
     def setUp(self) -> None:
@@ -870,3 +951,1541 @@ class MatchesTest(TestCase):
             self.skip_pattern, "Hey!\nYou need to SubsCribé to 10 ARTiclès\nto continue"
         )
         self.assertTrue(result)
+
+    def test_skip_rule(self):
+        rule = SkipRule(self.skip_pattern)
+        self.assertFalse(rule.matches("Title", "subscribe to 1 article"))
+        self.assertTrue(rule.matches("Title", "SubsCribé to 10 ARTiclès"))
+
+    def test_skip_rule_keywords(self):
+        rule = SkipRule(keywords=["sign in", "subscriber only", "Édition abonnés"])
+        self.assertTrue(rule.matches("For Subscriber Only"))
+        self.assertTrue(rule.matches("Title", "edition abonnes"))
+        self.assertFalse(rule.matches("Title", "subscribe"))
+
+    def test_keyword_pattern_shares_prefixes(self):
+        self.assertEqual(
+            keyword_pattern(["sign in", "sign up", "signal"]),
+            "SIGN(?:\\ (?:IN|UP)|AL)",
+        )
+
+    def test_skip_rule_from_config(self):
+        self.assertIsNone(SkipRule.from_config({"url": "https://example.com"}))
+        rule = SkipRule.from_config({"skip_keywords": ["paywall"]})
+        self.assertTrue(rule.matches("A PAYWALL"))
+
+
+class PolitenessTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def test_token_bucket_spacing(self):
+        bucket = TokenBucket(rate=0.5, capacity=1)
+        self.assertEqual(bucket.ready_in(now=bucket.updated), 0)
+        bucket.consume(now=bucket.updated)
+        self.assertAlmostEqual(bucket.ready_in(now=bucket.updated + 1), 1)
+        self.assertEqual(bucket.ready_in(now=bucket.updated + 1), 0)
+
+    def test_schedule_interleaves_hosts(self):
+        throttle = HostThrottle(delay=10)
+        urls = [
+            "https://a.example/1",
+            "https://a.example/2",
+            "https://a.example/3",
+            "https://b.example/1",
+        ]
+        order = []
+        for url in throttle.schedule(urls):
+            throttle.bucket(url).consume()
+            order.append(url)
+        self.assertEqual(
+            order,
+            [
+                "https://a.example/1",
+                "https://b.example/1",
+                "https://a.example/2",
+                "https://a.example/3",
+            ],
+        )
+
+    def test_schedule_is_lazy(self):
+        def endless():
+            n = 0
+            while True:
+                n += 1
+                yield "https://%s.example/%s" % ("ab"[n % 2], n)
+
+        throttle = HostThrottle(lookahead=3)
+        self.assertEqual(len(list(islice(throttle.schedule(endless()), 5))), 5)
+
+    def test_schedule_keeps_order_of_ready_hosts(self):
+        throttle = HostThrottle(delay=10)
+        urls = [
+            "https://a.example/1",
+            "https://a.example/2",
+            "https://b.example/1",
+            "https://c.example/1",
+        ]
+        order = []
+        for url in throttle.schedule(urls):
+            throttle.bucket(url).consume()
+            order.append(url)
+        # a.example/2 has to wait, so the others go first
+        self.assertEqual(
+            order,
+            [
+                "https://a.example/1",
+                "https://b.example/1",
+                "https://c.example/1",
+                "https://a.example/2",
+            ],
+        )
+
+    def test_retry_after_backs_off_host(self):
+        throttle = HostThrottle(max_wait=5)
+        resp = MagicMock()
+        resp.status_code = 429
+        resp.headers = {"Retry-After": "120"}
+        throttle.update("https://a.example/1", resp)
+
+        self.assertRaises(HostBackoffError, throttle.wait, "https://a.example/2")
+        throttle.wait("https://b.example/1")
+        self.assertEqual(list(throttle.schedule(["https://a.example/3"])), [])
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failures=2, backoff=60, max_backoff=100)
+        now = datetime.utcnow()
+        breaker.failure("https://a.example/1", now)
+        breaker.check("https://a.example/2", now)
+        breaker.failure("https://a.example/2", now)
+        self.assertEqual(breaker.open_for("https://a.example/3", now), 60)
+        self.assertRaises(HostUnavailableError, breaker.check, "https://a.example/3")
+        breaker.check("https://b.example/1", now)
+
+        # a failed probe backs off for longer, and a good one closes it
+        later = now + timedelta(seconds=61)
+        breaker.check("https://a.example/3", later)
+        breaker.failure("https://a.example/3", later)
+        self.assertEqual(breaker.open_for("https://a.example/3", later), 100)
+        breaker.success("https://a.example/4")
+        self.assertEqual(breaker.open_for("https://a.example/4", later), 0)
+        self.assertEqual(breaker.state("https://a.example/")["failures"], 0)
+
+    def test_circuit_breaker_state_is_kept(self):
+        memory_db()
+        breaker = CircuitBreaker(failures=1, load=Host.load, save=Host.store)
+        breaker.failure("https://a.example/1")
+        breaker = CircuitBreaker(failures=1, load=Host.load, save=Host.store)
+        self.assertGreater(breaker.open_for("https://a.example/2"), 0)
+        self.assertEqual(Host.get_by_id("a.example").failures, 1)
+
+    def test_host_store_updates(self):
+        memory_db()
+        Host.store("a.example", {"failures": 1, "backoff": 0, "open_until": None})
+        Host.store("a.example", {"failures": 2, "backoff": 60, "open_until": None})
+        self.assertEqual(Host.select().count(), 1)
+        self.assertEqual(Host.load("a.example")["failures"], 2)
+        self.assertEqual(Host.load("a.example")["backoff"], 60)
+
+    def test_failures_open_the_circuit(self):
+        memory_db()
+        client = MagicMock()
+        client.get.side_effect = requests.exceptions.ConnectTimeout()
+        with patch("diffengine.http_client", client), patch(
+            "diffengine.breaker", CircuitBreaker(failures=2)
+        ), patch("diffengine.throttle", HostThrottle()):
+            for i in range(2):
+                with self.assertRaises(requests.exceptions.ConnectTimeout):
+                    diffengine._get("https://a.example/%s" % i)
+            with self.assertRaises(HostUnavailableError):
+                diffengine._get("https://a.example/3")
+        self.assertEqual(client.get.call_count, 2)
+
+
+class HTTPClientTest(TestCase):
+    def test_session_per_host(self):
+        client = HTTPClient("test-agent")
+        s1 = client.session("https://a.example/1")
+        self.assertIs(s1, client.session("https://a.example/2"))
+        self.assertIsNot(s1, client.session("https://b.example/1"))
+        self.assertEqual(s1.headers["User-Agent"], "test-agent")
+        self.assertIn("gzip", s1.headers["Accept-Encoding"])
+
+    def test_cookies_are_not_kept(self):
+        client = HTTPClient("test-agent")
+        session = client.session("https://a.example/")
+        resp = MagicMock()
+        resp.info.return_value = email.message_from_string(
+            "Set-Cookie: metered=1; Path=/\n\n"
+        )
+        session.cookies.extract_cookies(
+            resp, urllib.request.Request("https://a.example/1")
+        )
+        self.assertEqual(len(session.cookies), 0)
+
+    def test_timeouts(self):
+        client = HTTPClient("test-agent", connect_timeout=5, read_timeout=30)
+        session = client.session("https://a.example/")
+        with patch.object(session, "get") as mocked_get:
+            client.get("https://a.example/1")
+            mocked_get.assert_called_once_with(
+                "https://a.example/1",
+                headers=None,
+                timeout=(5, 30),
+                allow_redirects=True,
+            )
+
+
+def get_response(url, content, status_code=200, headers={}):
+    resp = requests.Response()
+    resp.url = url
+    resp.status_code = status_code
+    resp.encoding = "utf-8"
+    resp.headers = requests.structures.CaseInsensitiveDict(headers)
+    resp._content = content
+    return resp
+
+
+class ResponseCacheTest(TestCase):
+    def setUp(self) -> None:
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.path)
+
+    def test_put_and_get(self):
+        cache = ResponseCache(self.path)
+        url = "https://example.org/story?x=1"
+        cache.put(url, get_response(url, b"<p>hello</p>", headers={"ETag": '"abc"'}))
+
+        resp = cache.get(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.text, "<p>hello</p>")
+        self.assertEqual(cache.validators(url), {"If-None-Match": '"abc"'})
+        self.assertIsNone(cache.get("https://example.org/other"))
+
+    def test_not_modified_uses_cached_body(self):
+        cache = ResponseCache(self.path)
+        url = "https://example.org/story"
+        cache.put(url, get_response(url, b"<p>hello</p>"))
+
+        resp = cache.update(url, get_response(url, b"", 304))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, b"<p>hello</p>")
+
+    def test_evicts_least_recently_used(self):
+        body = os.urandom(1000)
+        cache = ResponseCache(self.path, max_size=2500)
+        cache.put("https://example.org/1", get_response("https://example.org/1", body))
+        cache.put("https://example.org/2", get_response("https://example.org/2", body))
+        cache.get("https://example.org/1")
+        cache.put("https://example.org/3", get_response("https://example.org/3", body))
+
+        self.assertIsNotNone(cache.get("https://example.org/1"))
+        self.assertIsNone(cache.get("https://example.org/2"))
+        self.assertIsNotNone(cache.get("https://example.org/3"))
+
+
+class ReplayTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        memory_db()
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def test_replay_changes_nothing(self):
+        store = diffengine.artifacts
+        entry = Entry.create(url="https://example.com/story")
+
+        def run(options, checkpoint):
+            entry.checked = datetime(2020, 1, 1)
+            entry.save()
+            Entry.create(url="https://example.com/other")
+            diffengine.artifacts.write(1, "1.html", b"replayed")
+            checkpoint.save(next_feed="https://example.com/feed")
+
+        with patch("diffengine.run", side_effect=run):
+            diffengine.replay(diffengine.parse_args(["--replay", test_home]))
+
+        self.assertEqual(Entry.select().count(), 1)
+        self.assertNotEqual(Entry.get_by_id(entry.id).checked, datetime(2020, 1, 1))
+        self.assertIs(diffengine.artifacts, store)
+        self.assertFalse(store.exists(1, "1.html"))
+        self.assertFalse(os.path.exists(home_path("checkpoint.json")))
+
+    def test_profile_changes_nothing(self):
+        url = "https://example.com/profiled"
+
+        def check(entry, *args, **kwargs):
+            version = EntryVersion.create(entry=entry, title="t", summary="s", url=url)
+            version.archive()
+            diffengine.artifacts.write(1, "1.html", b"profiled")
+
+        with patch("diffengine.process_entry", side_effect=check), patch(
+            "diffengine._get"
+        ) as get:
+            paths = diffengine.profile_url(url)
+
+        get.assert_not_called()
+        self.assertEqual(Entry.select().count(), 0)
+        self.assertEqual(EntryVersion.select().count(), 0)
+        self.assertFalse(diffengine.artifacts.exists(1, "1.html"))
+        self.assertTrue(diffengine.archiving)
+        for path in paths:
+            self.assertTrue(os.path.isfile(path))
+            os.remove(path)
+
+
+class MetricsTest(TestCase):
+    def test_timer_and_prometheus(self):
+        metrics = Metrics()
+        with metrics.timer("fetch"):
+            pass
+        with metrics.timer("fetch"):
+            pass
+        metrics.inc("diffengine_entries_total", result="checked")
+
+        self.assertEqual(metrics.stages()["fetch"][0], 2)
+        text = metrics.prometheus()
+        self.assertIn('diffengine_entries_total{result="checked"} 1', text)
+        self.assertIn('diffengine_stage_seconds_count{stage="fetch"} 2', text)
+        self.assertIn(
+            'diffengine_stage_seconds_bucket{stage="fetch",le="+Inf"} 2', text
+        )
+
+    def test_nested_timers_count_self_time(self):
+        metrics = Metrics()
+        with metrics.timer("archive"):
+            busy(0.05)
+            with metrics.timer("fetch"):
+                busy(0.1)
+
+        stages = metrics.stages()
+        self.assertGreaterEqual(stages["fetch"][1], 0.1)
+        self.assertGreaterEqual(stages["archive"][1], 0.05)
+        self.assertLess(stages["archive"][1], 0.1)
+
+    def test_http_sink_listens_on_localhost(self):
+        metrics = Metrics()
+        sink = PrometheusHTTPSink(metrics, 0)
+        self.assertEqual(sink.server.server_address[0], "127.0.0.1")
+        sink.close(metrics)
+
+    def test_jsonl_sink(self):
+        path = os.path.join(tempfile.mkdtemp(), "metrics.jsonl")
+        metrics = Metrics([JSONLinesSink(path)])
+        metrics.observe("diffengine_stage_seconds", 0.5, stage="archive")
+        metrics.close()
+
+        with open(path) as fh:
+            record = json.loads(fh.readline())
+        self.assertEqual(record["stage"], "archive")
+        self.assertEqual(record["value"], 0.5)
+        shutil.rmtree(os.path.dirname(path))
+
+    def test_statsd_sink(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        metrics = Metrics([StatsDSink(*server.getsockname())])
+        metrics.inc("diffengine_entries_total", result="new")
+
+        self.assertEqual(server.recv(1024), b"diffengine.entries_total.new:1|c")
+        metrics.close()
+        server.close()
+
+
+def busy(seconds=0.1):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class ProfilingTest(TestCase):
+    def setUp(self) -> None:
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.path)
+
+    def test_cprofile(self):
+        paths = profile(busy, os.path.join(self.path, "busy"))
+        self.assertTrue(paths[0].endswith(".prof"))
+        for path in paths:
+            assert os.path.isfile(path)
+
+    def test_sampler_writes_collapsed_stacks(self):
+        paths = profile(busy, os.path.join(self.path, "busy"), "sample")
+        with open(paths[0]) as fh:
+            stack, count = fh.readline().rsplit(" ", 1)
+        self.assertIn("busy (test_diffengine.py:", stack)
+        self.assertTrue(int(count) > 0)
+
+
+class TextDiffTest(TestCase):
+    def test_changed_word(self):
+        diff = render_diff(
+            "<p>Hello there world. Foo bar.</p>", "<p>Hello big world. Foo bar.</p>"
+        )
+        self.assertEqual(
+            diff,
+            '<div class="diff"><p>Hello <del>there</del> <ins>big</ins> world. Foo bar.</p></div>',
+        )
+
+    def test_added_paragraph_keeps_markup(self):
+        diff = render_diff("<p>One.</p>", "<p>One.</p>\n<p>Two.</p>")
+        self.assertEqual(
+            diff, '<div class="diff"><p>One.</p>\n<p><ins>Two.</ins></p></div>'
+        )
+
+    def test_whitespace_is_not_a_change(self):
+        diff = render_diff("<p>a b  c</p>", "<p>a  b c</p>")
+        self.assertNotIn("<ins>", diff)
+        self.assertNotIn("<del>", diff)
+
+    def test_whitespace_between_tags(self):
+        old = tokenize("<p><b> Taxes will rise.</b> More.</p>")
+        new = tokenize("<p><b>Taxes will rise. </b>More.</p>")
+        assert_blocks_match(old, new, matching_blocks(opcodes(old, new)))
+
+    def test_blocks_match_fuzz(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            html = random_html(rng)
+            old, new = tokenize(html), tokenize(random_edit(rng, html))
+            assert_blocks_match(old, new, matching_blocks(opcodes(old, new)))
+
+    def test_same_changes_as_htmldiff2(self):
+        with open("test-data/article1.html") as fh:
+            old = fh.read()
+        with open("test-data/article2.html") as fh:
+            new = fh.read()
+        old = bleach.clean(readability.Document(old).summary(), tags=["p"], strip=True)
+        new = bleach.clean(readability.Document(new).summary(), tags=["p"], strip=True)
+        diff = render_diff(old, new)
+        expected = htmldiff2.render_html_diff(old, new)
+        self.assertEqual(diff.count("<ins>"), expected.count("<ins>"))
+        self.assertEqual(diff.count("<del>"), expected.count("<del>"))
+
+
+versions = [
+    "<p>The mayor said on Monday. Taxes will rise.</p>",
+    "<p>The mayor said on Tuesday. Taxes will rise.</p>\n<p>More to come.</p>",
+    "<p>The mayor said on Tuesday. Taxes will not rise.</p>\n<p>More to come.</p>",
+    "<p>The governor said on Tuesday. Taxes will not rise.</p>",
+]
+
+
+def memory_db():
+    generate_config(test_home, {"db": "sqlite:///:memory:"})
+    diffengine.home = test_home
+    load_config(prompt=False)
+    diffengine.setup_db()
+    diffengine.artifacts = diffengine.setup_artifacts()
+
+
+def blocks_between(old, new):
+    return matching_blocks(opcodes(tokenize(old), tokenize(new)))
+
+
+fuzz_words = ["The", "mayor", "said", "taxes", "will", "rise.", "not", "Monday."]
+
+
+def random_html(rng):
+    html = []
+    for _ in range(rng.randint(1, 4)):
+        html.append("<p>")
+        for _ in range(rng.randint(0, 8)):
+            html.append(rng.choice(["", "", " ", "<b>", "</b>"]))
+            html.append(rng.choice(fuzz_words) + rng.choice(["", " ", "  "]))
+        html.append("</p>" + rng.choice(["", "\n"]))
+    return "".join(html)
+
+
+def random_edit(rng, html):
+    tokens = tokenize(html)
+    for _ in range(rng.randint(0, 4)):
+        i = rng.randrange(len(tokens) + 1)
+        if i < len(tokens) and rng.random() < 0.4:
+            del tokens[i]
+        else:
+            tokens.insert(i, rng.choice(fuzz_words + [" ", "<b>", "</b>"]) + " ")
+    return "".join(tokens)
+
+
+def text(diff, leave_out=None):
+    # the text of a rendered diff without the deleted or inserted words,
+    # ignoring whitespace since markup is only kept from the new version
+    if leave_out:
+        diff = re.sub(r"<%s>.*?</%s>" % (leave_out, leave_out), "", diff, flags=re.S)
+    return re.sub(r"<[^>]+>|\s+", "", diff)
+
+
+def assert_blocks_match(old, new, blocks):
+    # trailing whitespace isn't significant, so tokens are compared by key
+    for i, j, n in blocks[:-1]:
+        assert [t.rstrip() for t in old[i : i + n]] == [
+            t.rstrip() for t in new[j : j + n]
+        ]
+    assert blocks[-1] == (len(old), len(new), 0)
+
+
+class ClipTest(TestCase):
+    page = (
+        "<html><head><title>Story</title></head><body>"
+        "<header>https://example.com/story</header>"
+        '<div class="diff"><h1>Story</h1>'
+        "<p>One.</p><p>Two <ins>more</ins>.</p><p>Three.</p>"
+        "<p>Four <del>big</del> <ins>bigger changes</ins>.</p><p>Five.</p><p>Six.</p>"
+        "</div></body></html>"
+    )
+
+    def test_clip(self):
+        # the h1 comes first, and the paragraph with the most changes is 4th
+        self.assertEqual(clip(self.page), (3, 5))
+
+    def test_clip_at_the_start(self):
+        page = '<html><body><div class="diff"><p><ins>New</ins></p><p>Old.</p></div></body></html>'
+        self.assertEqual(clip(page), (0, 1))
+
+    def test_nothing_to_clip(self):
+        page = '<html><body><header>x</header><div class="diff"><p>One.</p></div></body></html>'
+        self.assertIsNone(clip(page))
+
+    def test_screenshots_from_one_pass(self):
+        memory_db()
+        path = tempfile.mkdtemp()
+        diffengine.artifacts = LocalStore(path)
+        entry = Entry.create(url="https://example.com/story")
+        old, new = [
+            EntryVersion.create(title="Story", url=entry.url, summary=s, entry=entry)
+            for s in versions[:2]
+        ]
+        diff = Diff.create(old=old, new=new)
+        diffengine.artifacts.write(diff.id, diff.html_name, self.page.encode("utf8"))
+
+        out = io.BytesIO()
+        Image.new("RGB", (1400, 1640), "white").save(out, "PNG")
+        browser = MagicMock()
+        browser.execute_script.return_value = [1400, 1000, 1, [140, 1200, 1260, 1600]]
+        browser.get_screenshot_as_png.return_value = out.getvalue()
+        with patch("diffengine.browser", browser):
+            diff._take_screenshots()
+
+        browser.execute_script.assert_called_once_with(diffengine.CLIP_BOX, 3, 5)
+        browser.get_screenshot_as_png.assert_called_once()
+        browser.set_window_size.assert_called_with(1400, 1640)
+        screenshot = Image.open(diff.screenshot_path)
+        self.assertEqual(screenshot.size, (1400, 1000))
+        self.assertEqual(screenshot.mode, "P")
+        self.assertEqual(Image.open(diff.thumbnail_path).size, (800, 400))
+        shutil.rmtree(path)
+
+    def test_screenshots_are_taken_when_needed(self):
+        memory_db()
+        path = tempfile.mkdtemp()
+        diffengine.artifacts = LocalStore(path)
+        entry = Entry.create(url="https://example.com/story")
+        old, new = [
+            EntryVersion.create(title="Story", url=entry.url, summary=s, entry=entry)
+            for s in versions[:2]
+        ]
+        diff = Diff.create(old=old, new=new)
+
+        with patch.object(Diff, "_take_screenshots") as take:
+            self.assertTrue(diff.generate())
+            diff.prepare({"html"})
+            take.assert_not_called()
+            diff.prepare({"html", "thumbnail"})
+            take.assert_called_once()
+
+        with patch.object(Diff, "_take_screenshots") as take:
+            diffengine.artifacts.write(diff.id, diff.screenshot_name, png((10, 10)))
+            diffengine.artifacts.write(diff.id, diff.thumbnail_name, png((10, 10)))
+            self.assertTrue(os.path.isfile(diff.thumbnail_path))
+            take.assert_not_called()
+        shutil.rmtree(path)
+
+    def test_page_is_self_contained(self):
+        with open("diffengine/diff.html") as fh:
+            page = fh.read()
+        self.assertNotIn("<script", page)
+        self.assertNotIn("<link", page)
+
+
+class EditScriptTest(TestCase):
+    def test_round_trip(self):
+        old, new = tokenize(versions[0]), tokenize(versions[1])
+        ops = opcodes(old, new)
+        self.assertEqual(to_opcodes(matching_blocks(ops)), ops)
+
+    def test_compose(self):
+        blocks = blocks_between(versions[0], versions[1])
+        for old, new in zip(versions[1:], versions[2:]):
+            blocks = compose(blocks, blocks_between(old, new))
+
+        old, new = tokenize(versions[0]), tokenize(versions[-1])
+        self.assertEqual(blocks[-1], (len(old), len(new), 0))
+        for i, j, n in blocks[:-1]:
+            self.assertEqual(
+                [t.strip() for t in old[i : i + n]], [t.strip() for t in new[j : j + n]]
+            )
+        self.assertEqual(
+            render_diff(versions[0], versions[-1], blocks),
+            render_diff(versions[0], versions[-1]),
+        )
+
+    def test_compose_fuzz(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            a = random_html(rng)
+            b = random_edit(rng, a)
+            c = random_edit(rng, b)
+            blocks = compose(blocks_between(a, b), blocks_between(b, c))
+            assert_blocks_match(tokenize(a), tokenize(c), blocks)
+            # the composed diff may line words up differently than diffing
+            # a and c would, but it has to be the same change
+            for diff in (render_diff(a, c, blocks), render_diff(a, c)):
+                self.assertEqual(text(diff, "del"), text(c))
+                self.assertEqual(text(diff, "ins"), text(a))
+
+    def test_blocks_that_dont_match_are_ignored(self):
+        blocks = [(0, 0, 3), (5, 5, 0)]
+        self.assertEqual(
+            render_diff(versions[0], versions[1], blocks),
+            render_diff(versions[0], versions[1]),
+        )
+
+    def test_edit_script_is_only_made_when_needed(self):
+        memory_db()
+        entry = Entry.create(url="https://example.com/story")
+        old, new = [
+            EntryVersion.create(title="Story", url=entry.url, summary=s, entry=entry)
+            for s in versions[:2]
+        ]
+        diff = Diff.create(old=old, new=new)
+        self.assertTrue(diff.generate())
+        self.assertIsNone(Diff.get_by_id(diff.id).edit_script)
+
+        old.diff_to(new)
+        assert Diff.get_by_id(diff.id).edit_script
+
+    def test_diff_across_versions(self):
+        memory_db()
+        entry = Entry.create(url="https://example.com/story")
+        chain = []
+        for summary in versions:
+            chain.append(
+                EntryVersion.create(
+                    title="Story", url=entry.url, summary=summary, entry=entry
+                )
+            )
+        for old, new in zip(chain, chain[1:]):
+            diff = Diff.create(old=old, new=new)
+            diff.edit_blocks()
+            assert Diff.get_by_id(diff.id).edit_script
+
+        html = chain[0].diff_to(chain[-1])
+        self.assertEqual(html, render_diff(chain[0].html, chain[-1].html))
+        self.assertIn("<del>mayor</del> <ins>governor</ins>", html)
+        self.assertIn("<del>Monday.</del> <ins>Tuesday.</ins>", html)
+
+
+story = " ".join(
+    "Paragraph %s of the story has a few words about what happened." % i
+    for i in range(30)
+)
+
+
+def article(summary, url="https://example.com/story"):
+    resp = MagicMock()
+    resp.status_code = 200
+    resp.url = url
+    resp.text = (
+        "<html><head><title>Story</title></head><body><article><p>%s</p></article></body></html>"
+        % summary
+    )
+    return resp
+
+
+class SimilarityTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def test_similarity(self):
+        sig = signature(story)
+        self.assertEqual(similarity(sig, signature(story)), 1.0)
+        self.assertTrue(
+            similarity(sig, signature(story + " Updated 5 minutes ago")) > 0.8
+        )
+        self.assertTrue(similarity(sig, signature("Something else entirely.")) < 0.2)
+
+    def test_near_duplicate_is_skipped(self):
+        memory_db()
+        entry = Entry.create(url="https://example.com/story")
+        with patch("diffengine._get", return_value=article(story)), patch.object(
+            EntryVersion, "archive"
+        ), patch.object(Diff, "generate", return_value=True):
+            assert entry.get_latest(similarity_threshold=0.8)
+            with patch("diffengine._get", return_value=article(story + " Ad text.")):
+                self.assertIsNone(entry.get_latest(similarity_threshold=0.8))
+                self.assertIsNotNone(entry.get_latest())
+        self.assertEqual(EntryVersion.select().count(), 2)
+
+
+class CanonicalTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def test_url(self):
+        c = Canonicalizer(
+            strip_params=["utm_*", "fbclid", "cmp*"],
+            host_aliases={"amp.example.com": "www.example.com"},
+        )
+        self.assertEqual(
+            c.url(
+                "HTTPS://Amp.Example.com:443/a?utm_source=x&id=1&fbclid=2&cmpid=3#top"
+            ),
+            "https://www.example.com/a?id=1",
+        )
+
+    def test_canonical_link(self):
+        html = '<head><link href="/story" rel="canonical amphtml"></head><body><link rel="canonical" href="/nope"></body>'
+        self.assertEqual(canonical_link(html), "/story")
+        c = Canonicalizer()
+        self.assertEqual(
+            c.page_url("https://amp.example.com/x", html),
+            "https://amp.example.com/story",
+        )
+        self.assertEqual(
+            Canonicalizer(link_rel=False).page_url("https://example.com/x", html),
+            "https://example.com/x",
+        )
+
+    def test_front_page(self):
+        story_url = "https://example.com/politics/2020/story"
+        self.assertTrue(front_page("https://example.com/", story_url))
+        self.assertTrue(front_page("https://example.com/politics/", story_url))
+        self.assertFalse(front_page(story_url, story_url))
+        self.assertFalse(front_page("https://example.com/politics-story", story_url))
+        self.assertFalse(front_page("https://other.example/politics/", story_url))
+
+    def test_only_articles_are_merged(self):
+        memory_db()
+        link = '<head><link rel="canonical" href="https://example.com/politics/">'
+
+        def section_page(summary, url):
+            resp = article(summary, url)
+            resp.text = resp.text.replace("<head>", link)
+            return resp
+
+        first = Entry.create(url="https://example.com/politics/first")
+        second = Entry.create(url="https://example.com/politics/second")
+        with patch.object(EntryVersion, "archive"):
+            with patch("diffengine._get", return_value=section_page(story, first.url)):
+                self.assertEqual(first.get_latest().url, first.url)
+
+            # a page that points at the same section isn't the same article
+            resp = section_page("Another story.", second.url)
+            with patch("diffengine._get", return_value=resp):
+                assert second.get_latest()
+
+            # and pages that were sent somewhere else aren't merged by content
+            for url in ("https://consent.example.net/", "https://example.com/"):
+                entry = Entry.create(url="https://example.com/politics/" + url[8:12])
+                with patch("diffengine._get", return_value=article(story, url)):
+                    assert entry.get_latest()
+        self.assertFalse(Entry.select().where(Entry.duplicate_of.is_null(False)))
+
+    def test_duplicate_entries_are_merged(self):
+        memory_db()
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        first = Entry.create(url="https://example.com/story")
+        copy = Entry.create(url="https://syndicated.example.org/story")
+        FeedEntry.create(feed=feed, entry=first)
+        FeedEntry.create(feed=feed, entry=copy)
+        with patch.object(EntryVersion, "archive"):
+            with patch("diffengine._get", return_value=article(story)):
+                assert first.get_latest()
+            resp = article(story, copy.url)
+            with patch("diffengine._get", return_value=resp):
+                self.assertIsNone(copy.get_latest())
+
+        copy = Entry.get_by_id(copy.id)
+        self.assertEqual(copy.duplicate_of_id, first.id)
+        self.assertEqual(copy.original.id, first.id)
+        self.assertEqual([e.id for e in feed.entries], [first.id])
+
+
+rss = """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>Test</title>
+<item><title>Council votes on budget</title><link>https://example.com/budget</link></item>
+<item><title>LIVE: Election results</title><link>https://example.com/live/election</link></item>
+<item><title>Markets today</title><link>https://example.com/markets</link><category>Live blog</category></item>
+</channel></rss>"""
+
+
+class ItemRuleTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def test_match(self):
+        rule = ItemRule(title="^live:", url="/live/", category=["live blog"])
+        self.assertEqual(rule.match("LIVE: Election", "https://example.com/x"), "title")
+        self.assertEqual(rule.match("Election", "https://example.com/live/x"), "url")
+        self.assertEqual(
+            rule.match("Markets", categories=["Business", "Live Blog"]), "category"
+        )
+        self.assertIsNone(rule.match("Markets", "https://example.com/x", ["Business"]))
+
+    def test_skipped_items_are_not_fetched(self):
+        memory_db()
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        rule = ItemRule.from_config(
+            {"skip_items": {"title": "^live", "category": ["live blog"]}}
+        )
+        resp = MagicMock()
+        resp.text = rss
+        with patch("diffengine._get", return_value=resp):
+            self.assertEqual(feed.get_latest(rule), 3)
+        self.assertEqual([e.url for e in feed.entries], ["https://example.com/budget"])
+        markets = Entry.get(Entry.url == "https://example.com/markets")
+        self.assertEqual(
+            FeedEntry.get(FeedEntry.feed == feed, FeedEntry.entry == markets).skipped,
+            "category",
+        )
+
+        # the verdict is taken back if the rule changes
+        with patch("diffengine._get", return_value=resp):
+            feed.get_latest(ItemRule(url="/nothing/"))
+        self.assertEqual(len(feed.entries), 3)
+
+        # and when the rule is removed
+        with patch("diffengine._get", return_value=resp):
+            feed.get_latest(rule)
+            self.assertEqual(len(feed.entries), 1)
+            feed.get_latest()
+        self.assertEqual(len(feed.entries), 3)
+        self.assertEqual(diffengine._checkable(feed).count(), 3)
+
+    def test_skipping_is_per_feed(self):
+        memory_db()
+        skipping = Feed.create(name="Live", url="https://example.com/live.xml")
+        keeping = Feed.create(name="All", url="https://example.com/all.xml")
+        resp = MagicMock()
+        resp.text = rss
+        with patch("diffengine._get", return_value=resp):
+            skipping.get_latest(ItemRule(title="^live"))
+            keeping.get_latest(ItemRule(url="/nothing/"))
+            skipping.get_latest(ItemRule(title="^live"))
+            keeping.get_latest(ItemRule(url="/nothing/"))
+
+        self.assertEqual(len(skipping.entries), 2)
+        self.assertEqual(len(keeping.entries), 3)
+        self.assertEqual(diffengine._checkable(skipping).count(), 2)
+        self.assertEqual(diffengine._checkable(keeping).count(), 3)
+
+
+def signal_rss(updated, description="A story."):
+    return """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>Test</title>
+<item><title>Story</title><link>https://example.com/story</link>
+<pubDate>%s</pubDate><description>%s</description></item>
+</channel></rss>""" % (
+        updated,
+        description,
+    )
+
+
+class FeedSignalsTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        memory_db()
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def fetch(self, feed, text, max_age=None):
+        resp = MagicMock()
+        resp.text = text
+        with patch("diffengine._get", return_value=resp):
+            feed.get_latest(max_age=max_age)
+        return Entry.get(Entry.url == "https://example.com/story")
+
+    def test_updates_make_entries_due(self):
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        monday = "Mon, 02 Mar 2020 10:00:00 GMT"
+        entry = self.fetch(feed, signal_rss(monday))
+        feed_entry = FeedEntry.get(FeedEntry.entry == entry)
+        self.assertEqual(feed_entry.item_updated, datetime(2020, 3, 2, 10, 0))
+        self.assertIsNotNone(feed_entry.item_digest)
+
+        later = datetime.utcnow() + timedelta(days=1)
+        Entry.update(next_check=later, state=RETIRED).execute()
+        self.assertEqual(self.fetch(feed, signal_rss(monday)).next_check, later)
+
+        entry = self.fetch(feed, signal_rss("Tue, 03 Mar 2020 10:00:00 GMT"))
+        self.assertLessEqual(entry.next_check, datetime.utcnow())
+        self.assertEqual(entry.state, ACTIVE)
+
+        Entry.update(next_check=later).execute()
+        entry = self.fetch(feed, signal_rss("Tue, 03 Mar 2020 10:00:00 GMT", "Fixed."))
+        self.assertLessEqual(entry.next_check, datetime.utcnow())
+
+    def test_old_entries_stay_retired(self):
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        self.fetch(feed, signal_rss("Mon, 02 Mar 2020 10:00:00 GMT"))
+        Entry.update(
+            created=datetime.utcnow() - timedelta(days=40), state=RETIRED
+        ).execute()
+
+        tuesday = signal_rss("Tue, 03 Mar 2020 10:00:00 GMT")
+        self.assertEqual(self.fetch(feed, tuesday, max_age=30).state, RETIRED)
+        checkable = diffengine._checkable(feed, {"lifecycle": {"max_age": 30}})
+        self.assertEqual(checkable.count(), 0)
+
+        wednesday = signal_rss("Wed, 04 Mar 2020 10:00:00 GMT")
+        self.assertEqual(self.fetch(feed, wednesday, max_age=60).state, ACTIVE)
+
+    def test_items_are_looked_up_together(self):
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        resp = MagicMock()
+        resp.text = rss
+        with patch("diffengine._get", return_value=resp):
+            self.assertEqual(feed.get_latest(), 3)
+            # queries are counted from peewee's logging
+            logging.disable(logging.NOTSET)
+            with count_queries() as counter:
+                self.assertEqual(feed.get_latest(), 0)
+        self.assertEqual(counter.count, 2)
+        self.assertEqual(FeedEntry.select().count(), 3)
+
+    def test_signal_backoff_survives_state_changes(self):
+        now = datetime.utcnow()
+        entry = Entry.create(
+            url="https://example.com/story",
+            created=now - timedelta(hours=10),
+            checked=now,
+            unchanged_checks=2,
+        )
+        with patch("diffengine.signal_backoffs", {"https://example.com/feed": 3}):
+            entry.update_state(2, 4, "https://example.com/feed")
+        self.assertEqual(entry.state, COOLING)
+        self.assertEqual(entry.next_check, now + timedelta(hours=30))
+
+    def test_signal_backoff(self):
+        now = datetime.utcnow()
+        entry = Entry(created=now - timedelta(hours=10), checked=now)
+        self.assertEqual(
+            entry._next_check("https://example.com/feed"), now + timedelta(hours=2.5)
+        )
+        with patch("diffengine.signal_backoffs", {"https://example.com/feed": 3}):
+            self.assertEqual(
+                entry._next_check("https://example.com/feed"),
+                now + timedelta(hours=7.5),
+            )
+
+
+class RetentionTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.path)
+
+    def touch(self, name, days):
+        path = os.path.join(self.path, "1", name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.write("<p>diff</p>")
+        then = time.time() - days * 24 * 60 * 60
+        os.utime(path, (then, then))
+        return path
+
+    def test_sweep(self):
+        old_thumb = self.touch("1-thumb.png", 10)
+        new_thumb = self.touch("2-thumb.png", 1)
+        old_png = self.touch("1.png", 10)
+        old_html = self.touch("1.html", 10)
+        new_html = self.touch("2.html", 1)
+
+        counts = sweep(self.path, {"thumbnails": 7, "gzip_html": 3})
+        self.assertEqual(counts, {"removed": 1, "gzipped": 1, "packed": 0})
+        self.assertFalse(os.path.isfile(old_thumb))
+        self.assertTrue(os.path.isfile(new_thumb))
+        self.assertTrue(os.path.isfile(old_png))
+        self.assertFalse(os.path.isfile(old_html))
+        self.assertTrue(os.path.isfile(old_html + ".gz"))
+        self.assertTrue(os.path.isfile(new_html))
+
+        # gzipped files keep their age, so they are removed in time as well
+        sweep(self.path, {"html": 5})
+        self.assertFalse(os.path.isfile(old_html + ".gz"))
+        self.assertTrue(os.path.isfile(new_html))
+
+    def test_prune_versions(self):
+        memory_db()
+        diffengine.artifacts = LocalStore(self.path)
+        entry = Entry.create(url="https://example.com/story")
+        chain = [
+            EntryVersion.create(title="Story", url=entry.url, summary=s, entry=entry)
+            for s in versions
+        ]
+        for old, new in zip(chain, chain[1:]):
+            Diff.create(old=old, new=new)
+        diff = chain[-1].diff
+        diffengine.artifacts.write(diff.id, diff.html_name, b"<p>diff</p>")
+        retention.gzip_file(diff.html_path)
+        self.assertEqual(diff.read_html(), "<p>diff</p>")
+
+        count = diffengine.prune_versions(datetime.utcnow() + timedelta(days=1))
+        self.assertEqual(count, len(versions) - 1)
+        self.assertEqual([v.id for v in EntryVersion.select()], [chain[-1].id])
+        self.assertEqual(Diff.select().count(), 0)
+        self.assertIsNone(diff.read_html())
+
+
+class LifecycleTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        memory_db()
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def test_update_state(self):
+        entry = Entry.create(url="https://example.com/story")
+        self.assertEqual(entry.update_state(2, 4), ACTIVE)
+        entry.unchanged_checks = 2
+        self.assertEqual(entry.update_state(2, 4), COOLING)
+        entry.unchanged_checks = 4
+        self.assertEqual(entry.update_state(2, 4), RETIRED)
+        entry.unchanged_checks = 0
+        self.assertEqual(entry.update_state(2, 4), ACTIVE)
+        self.assertEqual(entry.update_state(), ACTIVE)
+
+    def test_unchanged_checks(self):
+        entry = Entry.create(url="https://example.com/story")
+        with patch.object(EntryVersion, "archive"), patch(
+            "diffengine._get", return_value=article(story)
+        ):
+            entry.get_latest()
+            self.assertEqual(entry.unchanged_checks, 0)
+            entry.get_latest()
+            entry.get_latest()
+            self.assertEqual(Entry.get_by_id(entry.id).unchanged_checks, 2)
+
+    def test_retired_entries_are_not_checked(self):
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        old = Entry.create(
+            url="https://example.com/old",
+            created=datetime.utcnow() - timedelta(days=40),
+        )
+        new = Entry.create(url="https://example.com/new")
+        quiet = Entry.create(url="https://example.com/quiet", state=RETIRED)
+        for entry in (old, new, quiet):
+            FeedEntry.create(feed=feed, entry=entry)
+
+        self.assertEqual(diffengine._checkable(feed).count(), 2)
+        checkable = diffengine._checkable(feed, {"lifecycle": {"max_age": 30}})
+        self.assertEqual([e.id for e in checkable], [new.id])
+        self.assertEqual(Entry.get_by_id(old.id).state, RETIRED)
+
+    def test_next_check(self):
+        now = datetime.utcnow()
+        entry = Entry.create(
+            url="https://example.com/story",
+            created=now - timedelta(hours=10),
+            checked=now - timedelta(hours=1),
+        )
+        self.assertEqual(entry._next_check(), entry.checked + timedelta(hours=2.25))
+        self.assertFalse(entry.stale)
+        entry.state = COOLING
+        self.assertEqual(entry._next_check(), entry.checked + timedelta(hours=9))
+        entry.next_check = now - timedelta(minutes=1)
+        self.assertTrue(entry.stale)
+
+    def test_due_entries_are_streamed(self):
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        now = datetime.utcnow()
+        due = Entry.create(url="https://example.com/due", next_check=now)
+        new = Entry.create(url="https://example.com/new")
+        later = Entry.create(
+            url="https://example.com/later", next_check=now + timedelta(hours=1)
+        )
+        for entry in (due, new, later):
+            FeedEntry.create(feed=feed, entry=entry)
+
+        rows = list(diffengine._scan(diffengine._due(diffengine._checkable(feed))))
+        self.assertEqual(sorted(r.id for r in rows), [due.id, new.id])
+        # only what is needed to schedule them is loaded
+        self.assertEqual(rows[0]._fields, ("id", "url"))
+
+    def test_skipped_entries_are_scheduled(self):
+        now = datetime.utcnow()
+        entry = Entry.create(
+            url="https://example.com/story",
+            created=now - timedelta(hours=10),
+            checked=now - timedelta(hours=1),
+        )
+        self.assertEqual(process_entry(entry)["skipped"], 1)
+        self.assertEqual(
+            Entry.get_by_id(entry.id).next_check, entry.checked + timedelta(hours=2.25)
+        )
+
+
+class LatestVersionTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        memory_db()
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def test_unchanged_without_loading_versions(self):
+        entry = Entry.create(url="https://example.com/story")
+        with patch.object(EntryVersion, "archive"), patch(
+            "diffengine._get", return_value=article(story)
+        ):
+            first = entry.get_latest()
+            entry = Entry.get_by_id(entry.id)
+            self.assertEqual(entry.latest_version_id, first.id)
+            with patch.object(EntryVersion, "select", side_effect=AssertionError):
+                self.assertIsNone(entry.get_latest())
+        self.assertEqual(entry.unchanged_checks, 1)
+
+    def test_pointer_follows_new_versions(self):
+        entry = Entry.create(url="https://example.com/story")
+        with patch.object(EntryVersion, "archive"), patch.object(
+            Diff, "generate", return_value=True
+        ):
+            with patch("diffengine._get", return_value=article(story)):
+                first = entry.get_latest()
+            with patch("diffengine._get", return_value=article(story + " More.")):
+                second = entry.get_latest()
+        self.assertEqual(second.diff.old.id, first.id)
+        entry = Entry.get_by_id(entry.id)
+        self.assertEqual(entry.latest_version_id, second.id)
+        self.assertEqual(entry.latest_title_hash, diffengine._sha1(second.title))
+
+    def test_versions_without_a_diff_are_removed(self):
+        entry = Entry.create(url="https://example.com/story")
+        with patch.object(EntryVersion, "archive"), patch.object(
+            Diff, "generate", return_value=False
+        ):
+            with patch("diffengine._get", return_value=article(story)):
+                first = entry.get_latest()
+            with patch("diffengine._get", return_value=article(story + " More.")):
+                self.assertIsNone(entry.get_latest())
+                self.assertIsNone(Entry.get_by_id(entry.id).get_latest())
+        self.assertEqual([v.id for v in EntryVersion.select()], [first.id])
+        self.assertEqual(Diff.select().count(), 0)
+        self.assertEqual(Entry.get_by_id(entry.id).latest_version_id, first.id)
+
+    def test_changes_are_found_from_the_hashes(self):
+        entry = Entry.create(url="https://example.com/story")
+        with patch.object(EntryVersion, "archive"), patch.object(
+            Diff, "generate", return_value=True
+        ):
+            with patch("diffengine._get", return_value=article(story)):
+                first = entry.get_latest()
+            # editing the stored version doesn't change what it is compared by
+            first.summary = first.summary[:-20]
+            first.save()
+            with patch("diffengine._get", return_value=article(story)):
+                self.assertIsNone(entry.get_latest())
+            with patch("diffengine._get", return_value=article(story[:-20])):
+                second = entry.get_latest()
+            self.assertEqual(second.diff.old.id, first.id)
+            changed_title = article(story[:-20])
+            changed_title.text = changed_title.text.replace(
+                "<title>", "<title>Updated: "
+            )
+            with patch("diffengine._get", return_value=changed_title):
+                third = entry.get_latest()
+            self.assertEqual(third.diff.old.id, second.id)
+
+    def test_pointer_is_filled_in_for_old_entries(self):
+        entry = Entry.create(url="https://example.com/story")
+        with patch.object(EntryVersion, "archive"), patch(
+            "diffengine._get", return_value=article(story)
+        ):
+            version = entry.get_latest()
+            Entry.update(
+                latest_version=None, latest_title_hash=None, latest_summary_hash=None
+            ).execute()
+            entry = Entry.get_by_id(entry.id)
+            self.assertIsNone(entry.get_latest())
+        self.assertEqual(Entry.get_by_id(entry.id).latest_version_id, version.id)
+
+
+class RunsTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.path)
+
+    def test_lock(self):
+        path = os.path.join(self.path, "diffengine.lock")
+        first, second = RunLock(path), RunLock(path)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+        second.release()
+
+    def test_locked_out_runs_dont_set_up(self):
+        lock = RunLock(os.path.join(self.path, "diffengine.lock"))
+        self.assertTrue(lock.acquire())
+        try:
+            with patch("sys.argv", ["diffengine", self.path]), patch(
+                "diffengine.init"
+            ) as init_, patch("diffengine.run") as run_:
+                diffengine.main()
+            init_.assert_not_called()
+            run_.assert_not_called()
+        finally:
+            lock.release()
+
+    def test_checkpoint(self):
+        checkpoint = Checkpoint(os.path.join(self.path, "checkpoint.json"))
+        self.assertEqual(checkpoint.load(), {})
+        checkpoint.save(next_feed="https://example.com/b")
+        self.assertEqual(checkpoint.load(), {"next_feed": "https://example.com/b"})
+        checkpoint.clear()
+        self.assertEqual(checkpoint.load(), {})
+
+    def test_deadline(self):
+        self.assertFalse(Deadline().expired)
+        self.assertFalse(Deadline(60).expired)
+        self.assertTrue(Deadline(0).expired)
+
+    def test_resume(self):
+        feeds = [{"url": u} for u in ("a", "b", "c")]
+        self.assertEqual([f["url"] for f in resume(feeds, "b")], ["b", "c", "a"])
+        self.assertEqual([f["url"] for f in resume(feeds, None)], ["a", "b", "c"])
+        self.assertEqual([f["url"] for f in resume(feeds, "gone")], ["a", "b", "c"])
+
+    def test_fair_share(self):
+        merged = fair_share([(1, "aaaaaa"), (2, "bbbbbb"), (1, "c")])
+        self.assertEqual("".join(merged), "babcbabbabaaa")
+        self.assertEqual(list(fair_share([])), [])
+        with self.assertRaises(ValueError):
+            list(fair_share([(0, "a")]))
+
+    def test_weighted_feeds(self):
+        feeds = [
+            {"name": "Busy", "url": "https://a.example/feed", "weight": 2},
+            {"name": "Quiet", "url": "https://b.example/feed"},
+        ]
+        generate_config(test_home, {"db": "sqlite:///:memory:", "feeds": feeds})
+        diffengine.home = test_home
+        load_config(prompt=False)
+        diffengine.setup_db()
+        diffengine.throttle = HostThrottle()
+        now = datetime.utcnow()
+        for f in feeds:
+            feed = Feed.create(name=f["name"], url=f["url"])
+            for i in range(4):
+                entry = Entry.create(
+                    url=f["url"].replace("feed", str(i)),
+                    created=now - timedelta(hours=i),
+                )
+                FeedEntry.create(feed=feed, entry=entry)
+
+        checked = []
+
+        def check(entry, *args, **kwargs):
+            checked.append(entry.url.split("/")[2][0])
+            return {"skipped": 0, "checked": 1, "new": 0}
+
+        with patch.object(Feed, "get_latest"), patch(
+            "diffengine.process_entry", side_effect=check
+        ):
+            diffengine.run(
+                diffengine.parse_args([test_home]),
+                Checkpoint(os.path.join(self.path, "checkpoint.json")),
+            )
+        self.assertEqual("".join(checked), "aabaabbb")
+
+    def test_stopped_runs_start_afresh(self):
+        feeds = [
+            {"name": "A", "url": "https://a.example/feed", "max_checks": 3},
+            {"name": "B", "url": "https://b.example/feed"},
+        ]
+        generate_config(test_home, {"db": "sqlite:///:memory:", "feeds": feeds})
+        diffengine.home = test_home
+        load_config(prompt=False)
+        diffengine.setup_db()
+        diffengine.throttle = HostThrottle()
+        for f in feeds:
+            feed = Feed.create(name=f["name"], url=f["url"])
+            for i in range(4):
+                entry = Entry.create(url=f["url"].replace("feed", str(i)))
+                FeedEntry.create(feed=feed, entry=entry)
+
+        checkpoint = Checkpoint(os.path.join(self.path, "checkpoint.json"))
+        checked = []
+        fetched = []
+
+        def check(entry, *args, **kwargs):
+            checked.append(entry.url)
+            entry.next_check = datetime.utcnow() + timedelta(days=1)
+            entry.save()
+            return {"skipped": 0, "checked": 1, "new": 0}
+
+        def get_latest(feed, *args):
+            fetched.append(feed.url)
+
+        def run(expired):
+            deadline = MagicMock()
+            type(deadline).expired = PropertyMock(side_effect=expired)
+            with patch.object(Feed, "get_latest", get_latest), patch(
+                "diffengine.process_entry", side_effect=check
+            ), patch("diffengine.Deadline", return_value=deadline):
+                diffengine.run(diffengine.parse_args([test_home]), checkpoint)
+
+        # runs that run out of time while fetching start at the feed the
+        # last one stopped at, but don't leave the other feeds unfetched
+        for i in range(3):
+            run(lambda: len(fetched) > i)
+        self.assertEqual(fetched, [feeds[0]["url"], feeds[1]["url"], feeds[0]["url"]])
+        self.assertEqual(checkpoint.load(), {"next_feed": feeds[1]["url"]})
+
+        # a run that runs out of time while checking leaves nothing behind,
+        # and the next one fetches every feed and gets all its max_checks
+        fetched.clear()
+        run(lambda: len(checked) >= 2)
+        self.assertEqual(len(checked), 2)
+        self.assertEqual(checkpoint.load(), {})
+        run(lambda: False)
+        self.assertEqual(sorted(fetched), sorted(2 * [f["url"] for f in feeds]))
+        self.assertEqual(
+            sum(url.startswith("https://a.example/") for url in checked), 4
+        )
+        self.assertEqual(len(checked), 8)
+
+    def test_most_overdue_first(self):
+        memory_db()
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        now = datetime.utcnow()
+        late = Entry.create(url="https://example.com/late", next_check=now)
+        later = Entry.create(
+            url="https://example.com/later", next_check=now - timedelta(hours=1)
+        )
+        fresh = Entry.create(url="https://example.com/fresh")
+        for entry in (late, later, fresh):
+            FeedEntry.create(feed=feed, entry=entry)
+
+        rows = diffengine._scan(diffengine._checkable(feed))
+        self.assertEqual([r.id for r in rows], [fresh.id, later.id, late.id])
+
+
+class ScheduleTest(TestCase):
+    def setUp(self) -> None:
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self) -> None:
+        logging.disable(logging.NOTSET)
+
+    def test_change_rate(self):
+        self.assertEqual(change_rate(0, 0, 0.5, 24), 0.5)
+        self.assertAlmostEqual(change_rate(6, 24, 0.5, 24), 0.375)
+        # a page that stops changing is expected to change less and less
+        self.assertGreater(change_rate(6, 24, 0.5, 24), change_rate(6, 240, 0.5, 24))
+
+    def test_interval(self):
+        schedule = AdaptiveSchedule(probability=0.5, prior_hours=24)
+        schedule.feed_rates["busy"] = 1.0
+        schedule.feed_rates["quiet"] = 0.01
+        busy = schedule.interval(0, timedelta(0), "busy")
+        self.assertAlmostEqual(busy.total_seconds(), 60 * 60 * 0.6931, delta=1)
+        self.assertGreater(schedule.interval(0, timedelta(0), "quiet"), busy)
+        # an entry's own changes count for more the longer it is watched
+        edited = schedule.interval(20, timedelta(hours=24), "quiet")
+        self.assertLess(edited, schedule.interval(0, timedelta(hours=24), "quiet"))
+        self.assertEqual(schedule.interval(0, timedelta(days=365)), timedelta(days=7))
+        self.assertEqual(
+            schedule.interval(10**6, timedelta(hours=1)), timedelta(minutes=15)
+        )
+
+    def test_feed_rate(self):
+        schedule = AdaptiveSchedule(prior_hours=24, default_rate=0.5)
+        self.assertAlmostEqual(schedule.feed_rate(3, 12), 15 / 36)
+
+    def test_history(self):
+        memory_db()
+        feed = Feed.create(name="Test", url="https://example.com/feed")
+        self.assertEqual(diffengine._history(feed), (0, 0))
+        now = datetime.utcnow()
+        entries = []
+        for changes, hours in [(3, 12), (1, 6), (5, 48)]:
+            entry = Entry.create(
+                url="https://example.com/%s" % changes,
+                created=now - timedelta(hours=hours),
+                checked=now,
+                changes=changes,
+                duplicate_of=entries[0] if entries[1:] else None,
+            )
+            FeedEntry.create(feed=feed, entry=entry)
+            entries.append(entry)
+        changes, hours = diffengine._history(feed)
+        self.assertEqual(changes, 4)
+        self.assertAlmostEqual(hours, 18, places=3)
+
+    def test_entries_are_scheduled_from_their_history(self):
+        memory_db()
+        schedule = AdaptiveSchedule()
+        schedule.feed_rates["https://example.com/feed"] = 2.0
+        entry = Entry.create(url="https://example.com/story")
+        with patch("diffengine.scheduler", schedule), patch.object(
+            EntryVersion, "archive"
+        ), patch.object(Diff, "generate", return_value=True):
+            with patch("diffengine._get", return_value=article(story)):
+                entry.get_latest(feed="https://example.com/feed")
+            with patch("diffengine._get", return_value=article(story + " More.")):
+                entry.get_latest(feed="https://example.com/feed")
+        self.assertEqual(entry.changes, 1)
+        self.assertEqual(
+            entry.next_check - entry.checked,
+            schedule.interval(
+                1, entry.checked - entry.created, "https://example.com/feed"
+            ),
+        )
+
+    def test_changes_are_counted_when_upgrading(self):
+        path = tempfile.mkdtemp()
+        db = os.path.join(path, "diffengine.db")
+        with sqlite3.connect(db) as conn:
+            conn.executescript("""
+                CREATE TABLE entry (id INTEGER PRIMARY KEY, url TEXT,
+                    created DATETIME, checked DATETIME,
+                    tweet_status_id_str VARCHAR(255) NOT NULL DEFAULT '');
+                CREATE TABLE entryversion (id INTEGER PRIMARY KEY, title TEXT,
+                    url TEXT, summary TEXT, created DATETIME, archive_url TEXT,
+                    entry_id INTEGER,
+                    tweet_status_id_str VARCHAR(255) NOT NULL DEFAULT '');
+                INSERT INTO entry VALUES (1, 'a', '2020-01-01', '2020-01-01', ''),
+                    (2, 'b', '2020-01-01', '2020-01-01', '');
+                INSERT INTO entryversion (title, url, summary, created, entry_id)
+                    VALUES ('t', 'a', '1', '2020-01-01', 1),
+                    ('t', 'a', '2', '2020-01-01', 1), ('t', 'a', '3', '2020-01-01', 1);
+                """)
+        generate_config(test_home, {"db": "sqlite:///" + db})
+        diffengine.home = test_home
+        load_config(prompt=False)
+        diffengine.setup_db()
+        self.assertEqual(
+            list(Entry.select(Entry.id, Entry.changes).order_by(Entry.id).tuples()),
+            [(1, 2), (2, 0)],
+        )
+        # the entries are scheduled rather than all being due at once
+        self.assertEqual(Entry.select().where(Entry.next_check.is_null()).count(), 0)
+        diffengine.database.close()
+        shutil.rmtree(path)
+
+
+class ArtifactStoreTest(TestCase):
+    def setUp(self) -> None:
+        self.path = tempfile.mkdtemp()
+        self.store = LocalStore(self.path, pack_size=20)
+
+    def tearDown(self) -> None:
+        self.store.close()
+        shutil.rmtree(self.path)
+
+    def test_layout(self):
+        path = self.store.write(1234, "1234.html", b"<p>diff</p>")
+        self.assertEqual(len(os.path.relpath(path, self.path).split(os.sep)), 3)
+        self.assertEqual(
+            os.path.dirname(path), os.path.dirname(self.store.path(1234, "1234.png"))
+        )
+        self.assertTrue(self.store.exists(1234, "1234.html"))
+        self.assertFalse(self.store.exists(1234, "1234.png"))
+        self.assertEqual(self.store.read(1234, "1234.html"), b"<p>diff</p>")
+        self.assertIsNone(self.store.read(1234, "1234.png"))
+
+    def test_pack(self):
+        for i in range(3):
+            path = self.store.write(
+                i, "%s.html" % i, b"<p>diff %s</p>" % str(i).encode()
+            )
+            self.store.pack(path)
+            self.assertFalse(os.path.isfile(path))
+        # small packs fill up and a new one is started
+        packs = [
+            p
+            for p in os.listdir(os.path.join(self.path, "packs"))
+            if p.endswith(".pack")
+        ]
+        self.assertEqual(len(packs), 3)
+        self.assertEqual(self.store.read(1, "1.html"), b"<p>diff 1</p>")
+        self.assertTrue(self.store.exists(2, "2.html"))
+        with open(self.store.local_path(2, "2.html"), "rb") as fh:
+            self.assertEqual(fh.read(), b"<p>diff 2</p>")
+        self.store.delete(0, "0.html")
+        self.assertFalse(self.store.exists(0, "0.html"))
+
+    def test_misconfigured_store_stops_init(self):
+        generate_config(test_home, {"artifacts": {"backend": "ftp"}})
+        with self.assertRaises(ArtifactStoreError):
+            init(test_home, prompt=False)
+        generate_config(test_home, {"artifacts": {"backend": "s3"}})
+        with self.assertRaises(ArtifactStoreError):
+            init(test_home, prompt=False)
+
+    def test_sweep_packs_html(self):
+        path = self.store.write(1, "1.html", b"<p>diff</p>")
+        then = time.time() - 10 * 24 * 60 * 60
+        os.utime(path, (then, then))
+        counts = sweep(self.path, {"pack_html": 7}, self.store.pack)
+        self.assertEqual(counts["packed"], 1)
+        self.assertEqual(self.store.read(1, "1.html"), b"<p>diff</p>")
+
+
+def png(size, color="white"):
+    out = io.BytesIO()
+    Image.new("RGB", size, color).save(out, "PNG")
+    return out.getvalue()
+
+
+class ImagesTest(TestCase):
+    def test_crop(self):
+        image = Image.open(io.BytesIO(crop(png((100, 100)), (10, 10, 60, 200))))
+        self.assertEqual(image.size, (50, 90))
+
+    def test_thumbnail_keeps_the_top(self):
+        thumb = thumbnail(png((1400, 3000)), (100, 100, 1300, 2900), padding=0)
+        self.assertEqual(Image.open(io.BytesIO(thumb)).size, (800, 400))
+
+    def test_thumbnail_pads_short_regions(self):
+        thumb = Image.open(
+            io.BytesIO(thumbnail(png((1400, 1000), "red"), (0, 0, 800, 100), padding=0))
+        )
+        self.assertEqual(thumb.size, (800, 400))
+        self.assertEqual(thumb.getpixel((10, 10)), (255, 0, 0))
+        self.assertEqual(thumb.getpixel((10, 390)), (255, 255, 255))
+
+    def test_quantize(self):
+        image = Image.open(
+            io.BytesIO(crop(png((100, 100)), (0, 0, 100, 100), colors=16))
+        )
+        self.assertEqual(image.mode, "P")